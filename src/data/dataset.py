@@ -6,9 +6,54 @@ from __future__ import print_function
 import os
 import io
 import csv
+import glob
+import json
+import multiprocessing
+from functools import partial
+from itertools import islice
+
 import numpy as np
 import tensorflow as tf
 
+# Lets tf.data tune the parallelism and buffer sizes
+AUTOTUNE = tf.contrib.data.AUTOTUNE
+
+PADDED_SHAPES = ({"source_seq": tf.TensorShape([None]), # pads to largest sentence in batch
+                  "source_len": tf.TensorShape([])}, # No padding
+                 {"target_seq": tf.TensorShape([None]),
+                  "target_len": tf.TensorShape([]),
+                  "decoder_tgt": tf.TensorShape([None])})
+
+# Dataset used by the worker processes of the sharded writer(set by _init_worker)
+_WORKER_DS = None
+
+def _init_worker(dataset):
+    """ Stores the dataset in the worker process so it isn't pickled with every chunk
+    Args:
+        dataset: The Dataset object holding the vocab used to encode the examples
+    """
+    global _WORKER_DS
+    _WORKER_DS = dataset
+
+def _serialize_chunk(chunk, packed=False):
+    """ Encodes and serializes a chunk of raw examples in a worker process
+    Args:
+        chunk: A list of [sent, label] pairs of text strings
+        packed: Serialize to the packed format
+    Returns:
+        A list of serialized examples
+    """
+    return [_WORKER_DS._serialize_pair(raw_ex, packed) for raw_ex in chunk]
+
+def manifest_path(record_path):
+    """ Returns the path of the manifest describing the shards written for record_path
+    Args:
+        record_path: Path of the record file(e.g data/processed/train.tfrecord)
+    Returns:
+        The manifest path(e.g data/processed/train.manifest.json)
+    """
+    return os.path.splitext(record_path)[0] + ".manifest.json"
+
 class Dataset(object):
     """ For reading data, processing for input, and writing to TFRecords
     """
@@ -16,11 +61,16 @@ class Dataset(object):
     def __init__(self, vocab):
         self.vocab = vocab
 
-    def dataset_to_example(self, data_path, record_path):
+    def dataset_to_example(self, data_path, record_path, num_shards=None, num_workers=None, chunk_size=1000, packed=False):
         """ Writes the dataset examples to TFRecords using the vocab to convert sequences of tokens to IDs
         Args:
             data_path: Path to the file containing the data
             record_path: Path to save the tfRecord file(s) to
+            num_shards: If set, stream the data through a process pool and write this many shards
+              (e.g train-00000-of-00008.tfrecord) next to record_path along with a manifest
+            num_workers: Number of worker processes for the sharded writer. Defaults to the number of cores
+            chunk_size: Number of examples sent to a worker at a time by the sharded writer
+            packed: Write every sequence as a single feature(see _make_packed_example)
         Returns:
             records: A list of record file paths that have been written
         """
@@ -28,6 +78,9 @@ class Dataset(object):
         if not os.path.isfile(data_path):
             raise Exception('ERROR: Path to directory does not exist or is not a directory')
 
+        if num_shards:
+            return self._sharded_dataset_to_example(data_path, record_path, num_shards, num_workers, chunk_size, packed)
+
         print("Reading data located at:", data_path)
 
         # Read a dataset
@@ -39,31 +92,137 @@ class Dataset(object):
         with open(record_path,'w') as fp:
             writer = tf.python_io.TFRecordWriter(fp.name)
             for raw_ex in data:
-                prepped_ex = list(map(self.vocab.prep_seq, raw_ex))
-                ex = self._make_example(sequence=prepped_ex[0], target=prepped_ex[1])
-                writer.write(ex.SerializeToString())
+                writer.write(self._serialize_pair(raw_ex, packed))
 
         print("Finished making TFRecords for %s" % data_path)
 
-        return
+        return [record_path]
 
-    def _read_csv_data(self, path):
-        """ Reads the training/validation data from the specified path
+    def _sharded_dataset_to_example(self, data_path, record_path, num_shards, num_workers, chunk_size, packed):
+        """ Streams the dataset through a process pool and writes the examples to num_shards TFRecord files.
+        Chunks are assigned to the shards round-robin, so the output is deterministic for a given chunk_size.
         Args:
-            path: The path of the training data
+            data_path: Path to the file containing the data
+            record_path: Path of the unsharded record file. Shards and the manifest are written next to it
+            num_shards: Number of shard files to write
+            num_workers: Number of worker processes
+            chunk_size: Number of examples per chunk
+            packed: Write the examples in the packed format
         Returns:
-            A list of examples(e.g [[sent1, label1],[sent2, label2]]) where each example is a list of [sent, label]
-            where sent and label is a text string
+            records: A list of the shard file paths that have been written
         """
+        num_workers = num_workers or multiprocessing.cpu_count()
+        record_dir = os.path.dirname(record_path)
+        stem = os.path.splitext(os.path.basename(record_path))[0]
+        records = [os.path.join(record_dir, "%s-%05d-of-%05d.tfrecord" % (stem, idx, num_shards)) for idx in range(num_shards)]
+        counts = [0]*num_shards
+
+        print("Processing {0} with {1} workers and writing {2} shards to: {3}".format(data_path, num_workers, num_shards, record_dir))
+
+        # split the streamed rows into chunks for the workers
+        rows = self._iter_csv_data(data_path)
+        chunks = iter(lambda: list(islice(rows, chunk_size)), [])
+
+        writers = [tf.python_io.TFRecordWriter(record) for record in records]
+        pool = multiprocessing.Pool(num_workers, initializer=_init_worker, initargs=(self,))
+        try:
+            for idx, serialized in enumerate(pool.imap(partial(_serialize_chunk, packed=packed), chunks)):
+                shard = idx % num_shards
+                for ex in serialized:
+                    writers[shard].write(ex)
+                counts[shard] += len(serialized)
+        finally:
+            pool.close()
+            pool.join()
+            for writer in writers:
+                writer.close()
+
+        # write the manifest so the input fn can find the shards
+        manifest = {
+            "source": os.path.basename(data_path),
+            "num_examples": sum(counts),
+            "packed": packed,
+            "shards": [{"path": os.path.basename(record), "num_examples": count} for record, count in zip(records, counts)]
+        }
+        with open(manifest_path(record_path), 'w') as fp:
+            json.dump(manifest, fp, indent=2)
+
+        print("Finished making %d TFRecord shards for %s" % (num_shards, data_path))
 
-        dataset = list()
+        return records
 
+    def _serialize_pair(self, raw_ex, packed=False):
+        """ Encodes a raw example and serializes it
+        Args:
+            raw_ex: A [sent, label] pair of text strings
+            packed: Serialize to the packed format
+        Returns:
+            The serialized tf.train.SequenceExample(or tf.train.Example if packed)
+        """
+        prepped_ex = list(map(self.vocab.prep_seq, raw_ex))
+        make_example = self._make_packed_example if packed else self._make_example
+        return make_example(sequence=prepped_ex[0], target=prepped_ex[1]).SerializeToString()
+
+    def _record_files(self, path, packed=None):
+        """ Finds the record files to read for the given path
+        Args:
+            path: Path to a record file, a shard manifest, a record file that was written as shards or a glob pattern.
+              Can also be a list or a comma separated string of these
+            packed: If set, the format the records are read in. It must match the format in the manifest
+        Returns:
+            A list of record file paths
+        """
+        if isinstance(path, (list, tuple)) or ',' in path:
+            paths = path if isinstance(path, (list, tuple)) else path.split(',')
+            return [record for p in paths for record in self._record_files(p, packed)]
+
+        if glob.has_magic(path):
+            records = sorted(glob.glob(path))
+            if not records:
+                raise Exception('ERROR: No files match the pattern: %s' % path)
+            return [record for p in records for record in self._record_files(p, packed)]
+
+        if not path.endswith(".json") and not os.path.isfile(path) and os.path.isfile(manifest_path(path)):
+            path = manifest_path(path)
+
+        if path.endswith(".json"):
+            with open(path) as fp:
+                manifest = json.load(fp)
+            if packed is not None and manifest.get("packed", False) != packed:
+                raise Exception('ERROR: The records of %s were written with packed=%s, but are read with packed=%s(--packed_records)'
+                                % (path, manifest.get("packed", False), packed))
+            records = [os.path.join(os.path.dirname(path), shard["path"]) for shard in manifest["shards"]]
+        else:
+            records = [path]
+
+        for record in records:
+            if not os.path.isfile(record):
+                raise Exception('ERROR: Provided path is not a file: %s' % record)
+
+        return records
+
+    def _iter_csv_data(self, path):
+        """ Streams the training/validation data from the specified path
+        Args:
+            path: The path of the training data
+        Yields:
+            An example [sent, label] where sent and label is a text string
+        """
         with open(path, 'r') as f:
             reader = csv.reader(f)
             for row in reader:
-                dataset.append([row[0],row[1]])
+                yield [row[0],row[1]]
 
-        return dataset
+    def _read_csv_data(self, path):
+        """ Reads the training/validation data from the specified path
+        Args:
+            path: The path of the training data
+        Returns:
+            A list of examples(e.g [[sent1, label1],[sent2, label2]]) where each example is a list of [sent, label]
+            where sent and label is a text string
+        """
+
+        return list(self._iter_csv_data(path))
 
     def _make_example(self, sequence, target):
         """ Returns a SequenceExample for the given inputs and labels
@@ -100,69 +259,208 @@ class Dataset(object):
 
         return tf.train.SequenceExample(context=tf.train.Features(feature=context_features), feature_lists=tf.train.FeatureLists(feature_list=feature_list))
 
-    def train_input_fn(self, path, batch_size):
+    def _make_packed_example(self, sequence, target):
+        """ Returns an Example for the given inputs and labels where every sequence is stored as a single Int64List
+        instead of one feature per ID. This is a lot cheaper to serialize and parse than the SequenceExample.
+        Args:
+            sequence: A list of input IDs.
+            target: A list of target IDs
+        Returns:
+            A tf.train.Example containing inputs and targets
+        """
+        # Convert list of IDs to a single int feature
+        def _int64_list_feature(values):
+            return tf.train.Feature(int64_list=tf.train.Int64List(value=values))
+
+        features = {
+            "source_len": _int64_list_feature([len(sequence)]),
+            "target_len": _int64_list_feature([len(target)-1]), # decoder_tgt and target have the same size
+            "source_seq": _int64_list_feature(sequence),
+            "target_seq": _int64_list_feature(target[:-1]), # original target seq with prepended start token
+            "decoder_tgt": _int64_list_feature(target[1:]) # original target seq with appended EOS token
+        }
+
+        return tf.train.Example(features=tf.train.Features(feature=features))
+
+    def length_boundaries(self, path, num_buckets=5, max_examples=100000, packed=False):
+        """ Derives bucket boundaries for train_input_fn from a histogram of the example lengths in the record file(s)
+        The boundaries are the quantiles of max(source_len, target_len) so every bucket gets a similar number of examples.
+        Args:
+            path: path of the record file to read. Can also be a shard manifest
+            num_buckets: The number of buckets to split the examples into
+            max_examples: The maximum number of examples to read for the histogram(spread over the shards)
+            packed: The records were written in the packed format
+        Returns:
+            A sorted list of at most num_buckets-1 bucket boundaries
+        """
+        records = self._record_files(path, packed)
+        per_record = max(1, max_examples // len(records))
+
+        lengths = []
+        for record in records:
+            for serialized in islice(tf.python_io.tf_record_iterator(record), per_record):
+                if packed:
+                    context = tf.train.Example.FromString(serialized).features.feature
+                else:
+                    context = tf.train.SequenceExample.FromString(serialized).context.feature
+                lengths.append(max(context["source_len"].int64_list.value[0], context["target_len"].int64_list.value[0]))
+
+        if not lengths:
+            raise Exception('ERROR: No examples to derive the bucket boundaries from in %s' % path)
+
+        # a bucket holds lengths in [boundaries[i-1], boundaries[i])
+        quantiles = np.percentile(lengths, [100.0*i/num_buckets for i in range(1, num_buckets)])
+        boundaries = sorted(set(int(q) + 1 for q in quantiles))
+
+        print("Bucket boundaries from {0} examples: {1}".format(len(lengths), boundaries))
+
+        return boundaries
+
+    def _parse(self, ex):
+        """ Explain to TF how to go back from a serialized example to tensors
+        Args:
+            ex: An example
+        Returns:
+            A dictionary of tensors
+        """
+        # Define how to parse the example
+        context_features = {
+            "source_len": tf.FixedLenFeature([], dtype=tf.int64),
+            "target_len": tf.FixedLenFeature([], dtype=tf.int64)
+        }
+        sequence_features = {
+            "source_seq": tf.FixedLenSequenceFeature([], dtype=tf.int64),
+            "target_seq": tf.FixedLenSequenceFeature([], dtype=tf.int64),
+            "decoder_tgt": tf.FixedLenSequenceFeature([], dtype=tf.int64)
+        }
+        #Parse the example and return dict of tensors
+        context_parsed, sequence_parsed = tf.parse_single_sequence_example(
+            serialized=ex,
+            context_features=context_features,
+            sequence_features=sequence_features
+        )
+
+        return {"source_seq": sequence_parsed["source_seq"],
+                "source_len": context_parsed["source_len"]}, {"target_seq": sequence_parsed["target_seq"],
+                                                              "target_len": context_parsed["target_len"],
+                                                              "decoder_tgt": sequence_parsed["decoder_tgt"]}
+
+    def _parse_packed(self, ex):
+        """ Parses one or a batch of serialized packed examples. Batches are padded to their longest sequence
+        Args:
+            ex: A serialized example or a vector of them
+        Returns:
+            A dictionary of tensors
+        """
+        features = {
+            "source_len": tf.FixedLenFeature([], dtype=tf.int64),
+            "target_len": tf.FixedLenFeature([], dtype=tf.int64),
+            "source_seq": tf.FixedLenSequenceFeature([], dtype=tf.int64, allow_missing=True),
+            "target_seq": tf.FixedLenSequenceFeature([], dtype=tf.int64, allow_missing=True),
+            "decoder_tgt": tf.FixedLenSequenceFeature([], dtype=tf.int64, allow_missing=True)
+        }
+        if ex.shape.ndims == 0:
+            parsed = tf.parse_single_example(ex, features)
+        else:
+            parsed = tf.parse_example(ex, features)
+
+        return {"source_seq": parsed["source_seq"],
+                "source_len": parsed["source_len"]}, {"target_seq": parsed["target_seq"],
+                                                      "target_len": parsed["target_len"],
+                                                      "decoder_tgt": parsed["decoder_tgt"]}
+
+    def train_input_fn(self, path, batch_size, bucket_boundaries=None, packed=False, shuffle_buffer=10000, num_parallel_calls=AUTOTUNE, num_workers=1, worker_index=0):
         """ Make a Tensorflow dataset that is shuffled, batched and parsed
         Args:
-            path: path of the record file to unpack and read
+            path: path of the record file to unpack and read. Can also be a shard manifest, a glob pattern or a list
+              of them. Multiple files are interleaved in parallel in a shuffled order
             batch_size: Size of the batch for training
+            bucket_boundaries: If set, batch examples of similar length together. A list of increasing lengths
+              splitting max(source_len, target_len) into buckets(see length_boundaries)
+            packed: The records were written in the packed format(see _make_packed_example)
+            shuffle_buffer: Number of examples in the shuffle buffer
+            num_parallel_calls: Number of examples or batches parsed in parallel. AUTOTUNE(-1) lets tf.data decide
+            num_workers: Number of workers training in parallel. Every worker reads a different part of the data
+            worker_index: Index of this worker in [0, num_workers)
         Returns:
             A dataset that is shuffled and padded
         """
 
-        if not os.path.isfile(path):
-            raise Exception('ERROR: Provided path is not a file')
-
-        def _parse(ex):
-            """ Explain to TF how to go back from a serialized example to tensors
-            Args:
-                ex: An example
-            Returns:
-                A dictionary of tensors
-            """
-            # Define how to parse the example
-            context_features = {
-                "source_len": tf.FixedLenFeature([], dtype=tf.int64),
-                "target_len": tf.FixedLenFeature([], dtype=tf.int64)
-            }
-            sequence_features = {
-                "source_seq": tf.FixedLenSequenceFeature([], dtype=tf.int64),
-                "target_seq": tf.FixedLenSequenceFeature([], dtype=tf.int64),
-                "decoder_tgt": tf.FixedLenSequenceFeature([], dtype=tf.int64)
-            }
-            #Parse the example and return dict of tensors
-            context_parsed, sequence_parsed = tf.parse_single_sequence_example(
-                serialized=ex,
-                context_features=context_features,
-                sequence_features=sequence_features
-            )
-
-            return {"source_seq": sequence_parsed["source_seq"],
-                    "source_len": context_parsed["source_len"]}, {"target_seq": sequence_parsed["target_seq"],
-                                                                  "target_len": context_parsed["target_len"],
-                                                                  "decoder_tgt": sequence_parsed["decoder_tgt"]}
-
-        dataset = tf.data.TFRecordDataset([path], num_parallel_reads=4).map(_parse, num_parallel_calls=10).shuffle(buffer_size=2*batch_size+1).repeat(None)
-
-        padded_shapes = ({"source_seq": tf.TensorShape([None]), # pads to largest sentence in batch
-            "source_len": tf.TensorShape([])}, # No padding
-            {"target_seq": tf.TensorShape([None]),
-            "target_len": tf.TensorShape([]),
-            "decoder_tgt": tf.TensorShape([None])})
-
-        dataset = dataset.padded_batch(batch_size, padded_shapes=padded_shapes)
+        records = self._record_files(path, packed)
+        if num_workers > 1 and len(records) >= num_workers:
+            # every worker reads its own shards
+            records = records[worker_index::num_workers]
+
+        if num_workers > 1 and len(records) < num_workers:
+            # not enough shards, every worker keeps its own examples of every file instead. This is done per file
+            # before the shuffle and interleave, so the workers split the data whatever order they read it in
+            read_records = lambda record: tf.data.TFRecordDataset(record).shard(num_workers, worker_index)
+        else:
+            read_records = tf.data.TFRecordDataset
+
+        # read the files in a new order every epoch and interleave their examples
+        files = tf.data.Dataset.from_tensor_slices(records).shuffle(len(records))
+        dataset = files.apply(tf.contrib.data.parallel_interleave(read_records,
+                                                                  cycle_length=min(len(records), multiprocessing.cpu_count()),
+                                                                  sloppy=True))
+
+        if packed and not bucket_boundaries:
+            # batch the serialized examples and parse every batch with a single op
+            dataset = dataset.shuffle(buffer_size=shuffle_buffer).repeat(None).batch(batch_size).map(self._parse_packed, num_parallel_calls=num_parallel_calls)
+
+            # enables pipelines
+            return dataset.prefetch(AUTOTUNE)
+
+        dataset = dataset.map(self._parse_packed if packed else self._parse, num_parallel_calls=num_parallel_calls).shuffle(buffer_size=shuffle_buffer).repeat(None)
+
+        if bucket_boundaries:
+            # pads to the largest sentence in the batch, but the batch only holds sentences of similar length
+            bucket_by_length = tf.contrib.data.bucket_by_sequence_length(
+                element_length_func=lambda features, labels: tf.to_int32(tf.maximum(features["source_len"], labels["target_len"])),
+                bucket_boundaries=bucket_boundaries,
+                bucket_batch_sizes=[batch_size]*(len(bucket_boundaries)+1),
+                padded_shapes=PADDED_SHAPES)
+            dataset = dataset.apply(bucket_by_length)
+        else:
+            dataset = dataset.padded_batch(batch_size, padded_shapes=PADDED_SHAPES)
 
         # enables pipelines
-        dataset = dataset.prefetch(2)
+        dataset = dataset.prefetch(AUTOTUNE)
 
         return dataset
 
-    def predict_input_fn(self, path, batch_size=1):
-        """ Used to shape input for predict mode
+    def eval_input_fn(self, path, batch_size, packed=False, num_batches=None, num_parallel_calls=AUTOTUNE):
+        """ Make a Tensorflow dataset for evaluation. It makes a single pass over the records in a fixed order, so
+        every evaluation sees the same examples
+        Args:
+            path: path of the record file(s) to read, see train_input_fn
+            batch_size: Size of the batches
+            packed: The records were written in the packed format(see _make_packed_example)
+            num_batches: If set, only the first num_batches batches are evaluated instead of the whole file(s)
+            num_parallel_calls: Number of examples or batches parsed in parallel. AUTOTUNE(-1) lets tf.data decide
+        Returns:
+            A finite dataset of padded batches
+        """
+        dataset = tf.data.TFRecordDataset(self._record_files(path, packed))
+
+        if packed:
+            dataset = dataset.batch(batch_size).map(self._parse_packed, num_parallel_calls=num_parallel_calls)
+        else:
+            dataset = dataset.map(self._parse, num_parallel_calls=num_parallel_calls).padded_batch(batch_size, padded_shapes=PADDED_SHAPES)
+
+        if num_batches:
+            dataset = dataset.take(num_batches)
+
+        return dataset.prefetch(AUTOTUNE)
+
+    def predict_input_fn(self, path, batch_size=1, max_len=None):
+        """ Used to shape input for predict mode. The file is streamed and every batch is padded to its longest row
         Args:
             path: Path to the data to be read
             batch_size: Optional batch size for prediction
+            max_len: If set, input sequences are cut to at most max_len IDs
         Returns:
-            dataset: A tf.data.Dataset where the tuple returned is features, _
+            input_fn: A function returning a tf.data.Dataset of features
         """
         if path is not None:
             assert batch_size is not None, "Error! If path is provided, batch size must be too!"
@@ -170,44 +468,22 @@ class Dataset(object):
         if not os.path.isfile(path):
             raise Exception("Error! The path provided is not a file.")
 
-        def _preprocess(ex):
-            """ Preprocesses the input
+        def _batches():
+            """ Reads batch_size lines at a time(skipping the header row) and preprocesses them
             """
-            parsed = self.vocab.prep_seq(ex)
-            ex_len = len(parsed)
-            return parsed, ex_len
-
-        # create the dataset and preprocess it.
-        seq_input = []
-        seq_len = []
-        with open(path) as file:
-            lines = file.readlines()
-            for idx, row in enumerate(lines):
-                if idx == 0:
-                    # skip header row 
-                    continue
-                else:
-                    parsed = self.vocab.prep_seq(row)
-                    seq_input.append(parsed)
-                    seq_len.append(len(parsed))
-            assert len(seq_input) == len(seq_len), "Error! seq_input must be the same length as the seq_len"
-
-        # pad the data
-        max_len = max(seq_len)
-        for idx, _ in enumerate(seq_input):
-            seq_input[idx].extend([0]*(max_len-seq_len[idx]))
-
-        # preprocess data
-        seq_input = np.array([np.asarray(x, dtype=np.int64) for x in seq_input])
-        seq_len = np.array([np.asarray(x, dtype=np.int64) for x in seq_len])
-
-        return tf.estimator.inputs.numpy_input_fn(
-            x={"source_seq": seq_input, "source_len": seq_len},
-            batch_size=batch_size,
-            shuffle=False
-        )
-
-
-
-
-
+            with open(path) as file:
+                next(file, None)
+                for lines in iter(lambda: list(islice(file, batch_size)), []):
+                    seq_input, seq_len = self.vocab.encode_batch(lines, max_len=max_len)
+                    yield {"source_seq": seq_input, "source_len": seq_len}
+
+        def input_fn():
+            dataset = tf.data.Dataset.from_generator(_batches,
+                                                     output_types={"source_seq": tf.int64, "source_len": tf.int64},
+                                                     output_shapes={"source_seq": tf.TensorShape([None, None]),
+                                                                    "source_len": tf.TensorShape([None])})
+
+            # enables pipelines
+            return dataset.prefetch(2)
+
+        return input_fn
@@ -118,7 +118,7 @@ def handle_coco(vocab):
     """ Handles all parsing of the raw MSCOCO dataset.
     This includes getting keeping only 4 captions per image and writing the dataset into CSV
     Args:
-        vocab: vocab object to build vocab with
+        vocab: vocab object to build vocab with. If None, the vocab is not built
     Returns:
         idx/total: Split from validation to train data
     """
@@ -149,7 +149,7 @@ def handle_coco(vocab):
             count = 0
             for img_id, caption in temp_dict.items():
                 count += 2
-                if dataset == COCO_TRAIN:
+                if dataset == COCO_TRAIN and vocab is not None:
                     # expand vocab
                     for sent in [caption[0], caption[1], caption[2], caption[3]]:
                         vocab.prep_train_seq(sent.rstrip())
@@ -167,6 +167,7 @@ def handle_quora(split, vocab):
     """ Read and process the raw Quora dataset
     Args:
         split: The split for train/val
+        vocab: vocab object to build vocab with. If None, the vocab is not built
     """
 
     print("Processing QUORA dataset...")
@@ -188,25 +189,34 @@ def handle_quora(split, vocab):
             if is_pair and (count <= train_split):
                 count += 1
                 # expand vocab
-                for sent in example:
-                    vocab.prep_train_seq(sent)
+                if vocab is not None:
+                    for sent in example:
+                        vocab.prep_train_seq(sent)
                 traincsv.writerow(example)
             elif is_pair:
                 count += 1
                 valcsv.writerow(example)
 
-def preprocess(vocab, max_keep=None):
+def preprocess(vocab, max_keep=None, num_shards=None, num_workers=None, parallel_vocab=False, packed=False):
     """ Prepare datasets, build vocab and write to tfRecords
     Args:
         vocab: vocab object to build vocab
         max_keep: The maximum number of words to keep. If None, it will write all words in the vocab dict to file.
+        num_shards: If set, write each tfRecord as this many shards in parallel(see Dataset.dataset_to_example)
+        num_workers: Number of processes used for writing the shards and building the vocab. Defaults to the number of cores
+        parallel_vocab: Build the vocab from the interim train CSV with a pool of workers instead of sentence by sentence
+        packed: Write the tfRecords in the packed format(one feature per sequence instead of one per ID)
     """
 
     # process coco dataset
-    coco_split = handle_coco(vocab)
+    coco_split = handle_coco(None if parallel_vocab else vocab)
 
     # process quroa dataset
-    handle_quora(coco_split, vocab)
+    handle_quora(coco_split, None if parallel_vocab else vocab)
+
+    # the train CSV holds exactly the sentences the serial path counts, in the same order
+    if parallel_vocab:
+        vocab.prep_train_csv(TRAIN_DATA, num_workers=num_workers)
 
     # save the vocabulary to the processed directory
     vocab.save_vocab(PROCESSED_DIR, max_keep=max_keep)
@@ -214,7 +224,7 @@ def preprocess(vocab, max_keep=None):
     print("Reading datasets and making tfRecords")
     handler = Dataset(vocab)
     for data, record in [(TRAIN_DATA, TRAIN_RECORD), (VAL_DATA, VAL_RECORD)]:
-        handler.dataset_to_example(data, record)
+        handler.dataset_to_example(data, record, num_shards=num_shards, num_workers=num_workers, packed=packed)
 
     return
 
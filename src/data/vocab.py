@@ -2,9 +2,13 @@
 from __future__ import absolute_import, division, print_function
 
 import csv
+import hashlib
 import io
+import multiprocessing
 import os
-from collections import Counter, defaultdict
+import re
+from collections import Counter, OrderedDict
+from itertools import islice
 
 import nltk
 import numpy as np
@@ -16,33 +20,197 @@ START = "<START>"
 EOS = "<EOS>"
 UNK = "<UNK>"
 
+class NltkTokenizer(object):
+    """ Tokenizes with nltk.word_tokenize(punkt sentence splitting + the improved Treebank word tokenizer) """
+    def tokenize(self, seq):
+        return nltk.word_tokenize(seq)
+
+class RegexTokenizer(object):
+    """ A port of the rules nltk.word_tokenize applies to every sentence, compiled once.
+    It skips the punkt sentence splitting(our captions and questions are one sentence per line) and returns plain
+    lowercase text with a single split. Run src/utils/bench_tokenizer.py to check the agreement with nltk on the data.
+    """
+    # text that none of the rules below change
+    PLAIN = re.compile(r"^[a-z0-9 ]*$")
+    PLAIN_CONTRACTIONS = re.compile(r"\b(?:cannot|gimme|gonna|gotta|lemme|wanna)\b")
+
+    STARTING_QUOTES = [
+        (re.compile(r"([«“‘„]|[`]+)"), r" \1 "),
+        (re.compile(r"^\""), r"``"),
+        (re.compile(r"(``)"), r" \1 "),
+        (re.compile(r"([ \(\[{<])(\"|\'{2})"), r"\1 `` "),
+        (re.compile(r"(?i)(?<!\w)(\')(?!(?:re|ve|ll|m|t|s|d|n)\b)(?=\w)"), r"\1 "),
+    ]
+    PUNCTUATION = [
+        (re.compile(r'([^\.])(\.)([\]\)}>"\'»”’ ]*)\s*$'), r"\1 \2 \3 "),
+        (re.compile(r"([:,])([^\d])"), r" \1 \2"),
+        (re.compile(r"([:,])$"), r" \1 "),
+        (re.compile(r"\.{2,}"), r" \g<0> "),
+        (re.compile(r"[;@#$%&]"), r" \g<0> "),
+        (re.compile(r"[\u2012-\u2015]"), r" \g<0> "),
+        (re.compile(r'([^\.])(\.)([\]\)}>"\']*)\s*$'), r"\1 \2\3 "),
+        (re.compile(r"[?!]"), r" \g<0> "),
+        (re.compile(r"([^'])' "), r"\1 ' "),
+        (re.compile(r"[*]"), r" \g<0> "),
+        (re.compile(r"[\]\[\(\)\{\}\<\>]"), r" \g<0> "),
+        (re.compile(r"--"), r" -- "),
+    ]
+    ENDING_QUOTES = [
+        (re.compile(r"([»”’])"), r" \1 "),
+        (re.compile(r"''"), " '' "),
+        (re.compile(r'"'), " '' "),
+        (re.compile(r"\s+"), " "),
+        (re.compile(r"([^' ])('[sS]|'[mM]|'[dD]|') "), r"\1 \2 "),
+        (re.compile(r"([^' ])('ll|'LL|'re|'RE|'ve|'VE|n't|N'T) "), r"\1 \2 "),
+    ]
+    CONTRACTIONS = [
+        re.compile(r"(?i)\b(can)(not)\b"),
+        re.compile(r"(?i)\b(d)('ye)\b"),
+        re.compile(r"(?i)\b(gim)(me)\b"),
+        re.compile(r"(?i)\b(gon)(na)\b"),
+        re.compile(r"(?i)\b(got)(ta)\b"),
+        re.compile(r"(?i)\b(lem)(me)\b"),
+        re.compile(r"(?i)\b(more)('n)\b"),
+        re.compile(r"(?i)\b(wan)(na)(?=\s)"),
+        re.compile(r"(?i) ('t)(is)\b"),
+        re.compile(r"(?i) ('t)(was)\b"),
+    ]
+
+    def tokenize(self, seq):
+        if self.PLAIN.match(seq) and not self.PLAIN_CONTRACTIONS.search(seq):
+            return seq.split()
+
+        for regexp, substitution in self.STARTING_QUOTES + self.PUNCTUATION:
+            seq = regexp.sub(substitution, seq)
+
+        # add extra space to make things easier
+        seq = " " + seq + " "
+        for regexp, substitution in self.ENDING_QUOTES:
+            seq = regexp.sub(substitution, seq)
+        for regexp in self.CONTRACTIONS:
+            seq = regexp.sub(r" \1 \2 ", seq)
+
+        return seq.split()
+
+class CachedTokenizer(object):
+    """ Wraps a tokenizer with a bounded LRU cache of tokenized sequences """
+    def __init__(self, tokenizer, maxsize=2**16):
+        """
+        Args:
+            tokenizer: The tokenizer to cache the results of
+            maxsize: The maximum number of sequences to keep in the cache
+        """
+        self.tokenizer = tokenizer
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+
+    def tokenize(self, seq):
+        tokens = self._cache.get(seq)
+        if tokens is not None:
+            self.hits += 1
+            self._cache.move_to_end(seq)
+            return list(tokens)
+
+        self.misses += 1
+        tokens = self.tokenizer.tokenize(seq)
+        self._cache[seq] = tuple(tokens)
+        if len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+
+        return tokens
+
+TOKENIZERS = {
+    "nltk": NltkTokenizer,
+    "regex": RegexTokenizer
+}
+
+def get_tokenizer(name="nltk", cache_size=2**16):
+    """ Makes a tokenizer backend
+    Args:
+        name: One of the keys of TOKENIZERS
+        cache_size: Size of the LRU cache in front of the backend. If 0 or None, results are not cached
+    Returns:
+        An object with a tokenize(seq) method
+    """
+    if name not in TOKENIZERS:
+        raise Exception("Invalid tokenizer %s. Must be one of %s" % (name, "/".join(TOKENIZERS)))
+
+    tokenizer = TOKENIZERS[name]()
+    if cache_size:
+        tokenizer = CachedTokenizer(tokenizer, cache_size)
+
+    return tokenizer
+
+# Vocab used by the worker processes of the parallel vocab builder(set by _init_worker)
+_WORKER_VOCAB = None
+
+def _init_worker(vocab):
+    """ Stores the vocab in the worker process so it isn't pickled with every chunk
+    Args:
+        vocab: The Vocab object whose tokenizer is used
+    """
+    global _WORKER_VOCAB
+    _WORKER_VOCAB = vocab
+
+def _count_chunk(chunk):
+    """ Tokenizes a chunk of rows in a worker process and counts the tokens
+    Args:
+        chunk: A list of rows where every column is a sentence
+    Returns:
+        A Counter of the tokens in the order they were first seen
+    """
+    counter = Counter()
+    for row in chunk:
+        for seq in row:
+            counter.update(_WORKER_VOCAB._tokenize(seq))
+    return counter
+
 class Vocab(object):
     """ For reading data, processing for input, and writing to TFRecords
     """
-    def __init__(self, vocab_path=None):
+    def __init__(self, vocab_path=None, tokenizer=None):
         """ Creates a vocab from training data and/or pretrained word vectors
         Args:
             vocab_path: Path to save/load the vocab file
+            tokenizer: The tokenizer backend(see get_tokenizer). Defaults to a cached nltk tokenizer
         """
-        self.vocab = defaultdict(self._next_val) # maps tokens to ids. Autogenerate next id as needed
-        self.reverse_vocab = {}
+        self.tokenizer = tokenizer or get_tokenizer()
         self.token_counter = Counter() # counts token frequency
+        self._reset_vocab()
 
-        # Add special characters to the vocab
-        self.vocab[PAD] = 0
-        self.vocab[START] = 1
-        self.vocab[EOS] = 2
-        self.vocab[UNK] = 3
-        self.next = 3 # after 2 is 3 and so on...
-
-        # Reads created vocab from file if it exists
+        # Reads created vocab from file if it exists. A loaded vocab is frozen
         if vocab_path and os.path.isfile(vocab_path):
             self.load_vocab(vocab_path)
 
-
-    def _next_val(self):
-        self.next += 1
-        return self.next
+    def _reset_vocab(self, tokens=()):
+        """ Resets the vocab to the special characters followed by the given tokens
+        Args:
+            tokens: Tokens to add after the special characters
+        """
+        self.id_to_token = [PAD, START, EOS, UNK] # maps ids to tokens(PAD is 0, START is 1 and so on...)
+        self.id_to_token.extend(tokens)
+        self.vocab = {token: id_ for id_, token in enumerate(self.id_to_token)} # maps tokens to ids
+        self.frozen = False # a frozen vocab raises instead of adding tokens
+        self._reverse_vocab = None # built on first use
+
+    def _add_token(self, token):
+        """ Returns the ID of a token and adds it to the vocab if it's new
+        Args:
+            token: A word
+        Returns:
+            An ID
+        """
+        id_ = self.vocab.get(token)
+        if id_ is None:
+            if self.frozen:
+                raise Exception("Can't add %s to a frozen vocab" % token)
+            id_ = len(self.id_to_token)
+            self.vocab[token] = id_
+            self.id_to_token.append(token)
+            self._reverse_vocab = None
+        return id_
 
     def prep_train_seq(self, seq):
         """ Preprocesses text input and build vocabulary
@@ -56,6 +224,37 @@ class Vocab(object):
 
         return
 
+    def prep_train_csv(self, path, num_workers=None, chunk_size=1000):
+        """ Builds the vocabulary from every sentence of a CSV file using a pool of worker processes.
+        The partial counts of the chunks are merged in file order, so the result(and the vocab written by save_vocab)
+        is the same as calling prep_train_seq on every sentence in order.
+        Args:
+            path: Path to a CSV file where every column is a sentence(e.g the interim train_data.csv)
+            num_workers: Number of worker processes. Defaults to the number of cores
+            chunk_size: Number of rows sent to a worker at a time
+        """
+
+        if not os.path.isfile(path):
+            raise Exception('ERROR: Path to the CSV file does not exist')
+
+        num_workers = num_workers or multiprocessing.cpu_count()
+        print("Building vocab from {0} with {1} workers".format(path, num_workers))
+
+        with open(path, 'r') as f:
+            rows = csv.reader(f)
+            chunks = iter(lambda: list(islice(rows, chunk_size)), [])
+            pool = multiprocessing.Pool(num_workers, initializer=_init_worker, initargs=(self,))
+            try:
+                for counter in pool.imap(_count_chunk, chunks):
+                    # merge the partial counts and add the new tokens to the vocab
+                    self.token_counter.update(counter)
+                    [self._add_token(token) for token in counter]
+            finally:
+                pool.close()
+                pool.join()
+
+        return
+
     def prep_seq(self, seq):
         """ Preprocesses text, but does not add to the vocab(see prep_train_seq for this)
         Args:
@@ -66,14 +265,37 @@ class Vocab(object):
 
         seq = self._tokenize(seq)
 
-        seq = list(map(self._tok_to_id, seq))
-
         # Add START and EOS tokens
-        seq.insert(0, self.vocab[START])
-        seq.append(self.vocab[EOS])
+        seq = [self.vocab[START]] + [self._tok_to_id(token) for token in seq] + [self.vocab[EOS]]
 
         return seq
 
+    def encode_batch(self, seqs, max_len=None, dtype=np.int64):
+        """ Preprocesses a batch of text into a padded array of IDs(the same IDs as prep_seq). Unlike prep_seq, this
+        doesn't update the token_counter.
+        Args:
+            seqs: A list of sequences to be prepared
+            max_len: If set, sequences are cut to at most max_len IDs(including the START and EOS tokens)
+            dtype: The integer type of the returned arrays
+        Returns:
+            ids: np array of shape (len(seqs), longest_seq) padded with PAD
+            lengths: np array of shape (len(seqs),) with the number of IDs in every row
+        """
+        unk, start, eos = self.vocab[UNK], self.vocab[START], self.vocab[EOS]
+        tokens = [self._tokenize(seq) for seq in seqs]
+        if max_len is not None:
+            tokens = [toks[:max_len-2] for toks in tokens]
+
+        lengths = np.fromiter((len(toks)+2 for toks in tokens), dtype=dtype, count=len(tokens))
+        ids = np.zeros((len(tokens), lengths.max(initial=2)), dtype=dtype) # PAD is 0
+        ids[:, 0] = start
+        get = self.vocab.get
+        for row, (toks, length) in enumerate(zip(tokens, lengths)):
+            ids[row, 1:length-1] = [get(token, unk) for token in toks]
+            ids[row, length-1] = eos
+
+        return ids, lengths
+
     def _tokenize(self, seq):
         """ Tokenizes the input sequence.
         Args:
@@ -82,7 +304,7 @@ class Vocab(object):
             A list of tokens(e.g words or charcters)
         """
         seq = seq.lower()
-        return nltk.word_tokenize(seq)
+        return self.tokenizer.tokenize(seq)
 
     def _tok_to_id(self, token, build_vocab=False):
         """ Maps a token to it's corresponding ID. Or if in training mode, also adds new words to the vocab
@@ -95,7 +317,7 @@ class Vocab(object):
 
         if build_vocab:
             self.token_counter[token] += 1
-            return self.vocab[token]
+            return self._add_token(token)
         elif token in self.vocab:
             self.token_counter[token] += 1
             return self.vocab[token]
@@ -103,70 +325,105 @@ class Vocab(object):
             self.token_counter[UNK] += 1
             return self.vocab[UNK]
 
+    @property
+    def reverse_vocab(self):
+        """ An array mapping ids to tokens that is built on first use
+        """
+        if self._reverse_vocab is None:
+            self.make_reverse_vocab()
+        return self._reverse_vocab
+
     def make_reverse_vocab(self):
         """ Makes a reverse vocab for the given vocab.
         """
-        self.reverse_vocab = {id_:token for token,id_ in self.vocab.items()}
+        self._reverse_vocab = np.array(self.id_to_token, dtype=object)
 
     def ids_to_text(self, id_list):
-        """ Maps a sequence of IDs to a string
+        """ Maps a sequence of IDs to a string. Decoding stops at the first EOS or PAD(or invalid) ID
         Args:
-            id_list: A sequence of IDs
+            id_list: A sequence or np array of IDs. If 2D(or a list of sequences of different lengths), every row is decoded
         Returns:
-            text: A text string that is supposed to be a sentence
+            text: A text string that is supposed to be a sentence(a list of them for 2D input)
         """
+        if len(id_list) and np.ndim(id_list[0]) > 0:
+            # decode row by row, the rows don't have to be padded to the same length
+            return [self.ids_to_text(row) for row in id_list]
+
+        ids = np.asarray(id_list, dtype=np.int64)
+
+        stop = np.flatnonzero((ids == self.vocab[EOS]) | (ids == self.vocab[PAD]) | (ids < 0) | (ids >= len(self.id_to_token)))
+        if stop.size:
+            ids = ids[:stop[0]]
+
+        text = ' '.join(self.reverse_vocab[ids])
 
-        text = ''.join(map(lambda x:self.reverse_vocab[x],id_list))
-        
         return text
 
-    def read_embeddings(self, path, use_init=False, load_np=True):
-        """ Reads word embeddings from file that are saved in the FastText format
+    def read_embeddings(self, path, use_init=False, load_np=True, cache_dir=None):
+        """ Reads word embeddings from file that are saved in the FastText format.
+        Only the vectors of words in the vocab are kept and the matrix is cached as a .npy file keyed by the vocab and
+        the embedding file, so later runs memory map it instead of parsing the embedding file.
         Args:
             path: Path to the embedding file
             use_init: Return the init function, instead of the np array
-            load_np: Load np array
+            load_np: Load the cached np array if it exists. If False, the cache is rebuilt
+            cache_dir: Directory of the cached matrix(e.g the model_dir). Defaults to the directory of the embedding file
         Returns:
-            embedding_initializer: An initializer for pre-trained embeddings
+            embedding_initializer: An initializer for pre-trained embeddings or the embedding matrix
         """
 
         if not os.path.isfile(path):
             raise Exception('ERROR! Filepath is not a file')
 
-        print("Reading embeddings from:", path)
-
         def embed_initializer(shape=None, dtype=tf.float32, partition_info=None):
             assert dtype is tf.float32
             return embedding_matrix
 
-        if load_np:
-            embedding_matrix = np.load("/home/tldr/Projects/models/current/VAE-LSTM/data/external/emb_matrix.npy")
+        cache_path = self._embedding_cache_path(path, cache_dir)
+        if load_np and os.path.isfile(cache_path):
+            print("Loading cached embeddings from:", cache_path)
+            embedding_matrix = np.load(cache_path, mmap_mode='r')
             if use_init:
                 return embed_initializer
             else:
                 return embedding_matrix
 
-        fin = io.open(path, 'r', encoding='utf-8', newline='\n', errors='ignore')
-        _, dim = map(int, fin.readline().split())
-
-        # read the fasttext embeddings into a dictionary
-        embeddings = {}
-        for line in fin:
-            tokens = line.rstrip().split(' ')
-            embeddings[tokens[0]] = np.asarray(tokens[1:], dtype='float32')
+        print("Reading embeddings from:", path)
 
-        # turn the embeddings dict into a numpy array
+        # stream the fasttext embeddings and only parse the vectors of words in the vocab
         vsize = len(self.vocab)
-        embedding_matrix = np.random.uniform(-1, 1, size=(vsize, dim))
-        for w, i in self.vocab.items():
-            v = embeddings.get(w)
-            if v is not None and i < vsize:
-                embedding_matrix[i] = v
+        with io.open(path, 'r', encoding='utf-8', newline='\n', errors='ignore') as fin:
+            _, dim = map(int, fin.readline().split())
+            embedding_matrix = np.random.uniform(-1, 1, size=(vsize, dim)).astype(np.float32)
+            for line in fin:
+                word, vec = line.rstrip().split(' ', 1)
+                i = self.vocab.get(word)
+                if i is not None and i < vsize:
+                    embedding_matrix[i] = np.asarray(vec.split(' '), dtype=np.float32)
 
         # save to numpy array format
-        np.save("/home/tldr/Projects/models/current/VAE-LSTM/data/external/emb_matrix.npy", embedding_matrix)
+        print("Saving embeddings to:", cache_path)
+        np.save(cache_path, embedding_matrix)
 
-        return embed_initializer
+        if use_init:
+            return embed_initializer
+        else:
+            return embedding_matrix
+
+    def _embedding_cache_path(self, path, cache_dir=None):
+        """ Returns the path of the cached embedding matrix for this vocab and embedding file
+        Args:
+            path: Path to the embedding file
+            cache_dir: Directory of the cached matrix. Defaults to the directory of the embedding file
+        Returns:
+            The path of the .npy file(e.g emb_matrix-<hash>.npy)
+        """
+        key = hashlib.sha1()
+        key.update(("%s\t%d\n" % (os.path.basename(path), os.path.getsize(path))).encode('utf-8'))
+        for id_, token in enumerate(self.id_to_token):
+            key.update(("%s\t%d\n" % (token, id_)).encode('utf-8'))
+
+        return os.path.join(cache_dir or os.path.dirname(path), "emb_matrix-%s.npy" % key.hexdigest()[:16])
 
     def save_vocab(self, path, max_keep=None):
         """ Saves the vocabulary to file.
@@ -189,24 +446,14 @@ class Vocab(object):
         freq_tokens = self.token_counter.most_common(max_keep)
 
         # rewrite self.vocab
-        self.vocab.clear()
-        self.vocab[PAD] = 0
-        self.vocab[START] = 1
-        self.vocab[EOS] = 2
-        self.vocab[UNK] = 3
-        self.next = 3
-        for token, _ in freq_tokens:
-            self.vocab[token]
+        self._reset_vocab(token for token, _ in freq_tokens)
 
         with open(path, 'w') as vocab_tsv:
             # write the first line
             writer = csv.writer(vocab_tsv, delimiter='\t')
             writer.writerow(['Word', 'ID'])
-            for word, id_ in self.vocab.items():
-                # skip adding special tokens
-                if id_ < 4:
-                    continue
-                writer.writerow([word, id_])
+            # skip adding special tokens
+            writer.writerows((word, id_) for id_, word in enumerate(self.id_to_token[4:], 4))
 
         print("Finished writing to vocab")
 
@@ -225,17 +472,19 @@ class Vocab(object):
 
         with open(path, 'r') as vocab_f:
             vocab_f = csv.reader(vocab_f, delimiter='\t')
-            for idx, line in enumerate(vocab_f):
-                # skip the header
-                if idx == 0:
-                    continue
-                word = line[0]
-                if word in self.vocab:
-                    raise Exception("Duplicate word %s found in vocab" % word)
-
-                # add the word to the vocab at the same ID(hopefully)
-                self.vocab[word]
-                if self.vocab[word] != int(line[1]):
-                    raise Exception("The read word in the vocab does not match the ID it was given in the vocab file. Please check the vocab file.")
-                
+            next(vocab_f) # skip the header
+            rows = list(vocab_f)
+
+        # the words must be stored in order of their IDs after the special characters
+        words = [line[0] for line in rows]
+        if [int(line[1]) for line in rows] != list(range(len(self.id_to_token), len(self.id_to_token)+len(rows))):
+            raise Exception("The read word in the vocab does not match the ID it was given in the vocab file. Please check the vocab file.")
+
+        self._reset_vocab(self.id_to_token[4:] + words)
+        if len(self.vocab) != len(self.id_to_token):
+            duplicate = next(word for word, count in Counter(self.id_to_token).items() if count > 1)
+            raise Exception("Duplicate word %s found in vocab" % duplicate)
+
+        self.frozen = True
+
         return
@@ -1,18 +1,23 @@
 """ This is the command line interface for the implementation of the Recurrent Variational Autoencoder """
 from __future__ import absolute_import, division, print_function
 
+import json
 import os
 import sys
+import time
 
 import numpy as np
 import tensorflow as tf
 
 from collections import namedtuple
+from nltk.translate.bleu_score import corpus_bleu
 sys.path.append('../')
 from src.data.dataset import Dataset
-from src.data.vocab import Vocab
+from src.data.vocab import Vocab, get_tokenizer
 from src.models.rvae import RVAE
 from src.utils.load_config import ModelParams, AppConfig
+from src.utils.profile import format_scope_table, profile_ops, scope_table, write_chrome_trace
+from src.utils.quantize import fake_quantize_checkpoint, quantize_saved_model, rss_mb, saved_model_size
 
 FLAGS = tf.app.flags.FLAGS
 
@@ -21,41 +26,112 @@ tf.app.flags.DEFINE_string('app_config', '', 'profile for the app configuration'
 tf.app.flags.DEFINE_string('model_params', '', 'profile for the model hyperparameters')
 
 # Where to find data
-tf.app.flags.DEFINE_string('data_path', '/home/tldr/Projects/models/current/VAE-LSTM/data/processed/train.tfrecord', 'Path to the tf.Record data files or text file if predicting.')
+tf.app.flags.DEFINE_string('data_path', '/home/tldr/Projects/models/current/VAE-LSTM/data/processed/train.tfrecord', 'Path to the tf.Record data files(a file, shard manifest, glob or comma separated list) or text file if predicting.')
 tf.app.flags.DEFINE_string('eval_path', '/home/tldr/Projects/models/current/VAE-LSTM/data/processed/val.tfrecord', 'Path to the tf.Record data file for eval.')
 tf.app.flags.DEFINE_string('vocab_path', '/home/tldr/Projects/models/current/VAE-LSTM/data/processed/vocab.tsv', 'Path to the saved vocab file.')
-tf.app.flags.DEFINE_string('embed_path', '/home/tldr/Projects/models/current/VAE-LSTM/data/external/crawl-300d-2M.vec', 'Path to the serialized pretrained embedding matrix.')
+tf.app.flags.DEFINE_string('embed_path', '/home/tldr/Projects/models/current/VAE-LSTM/data/external/crawl-300d-2M.vec', 'Path to the pretrained FastText embeddings. The matrix for the vocab is cached in model_dir.')
 tf.app.flags.DEFINE_string('checkpoint_path', '', 'Path to the model checkpoint.')
+tf.app.flags.DEFINE_string('tokenizer', 'nltk', 'Tokenizer backend used by the vocab. Must be one of nltk/regex')
 
 # Model settings
-tf.app.flags.DEFINE_string('mode', 'train', 'must be one of train/predict/save_embed/eval')
+tf.app.flags.DEFINE_string('mode', 'train', 'must be one of train/predict/encode/quantize/profile/save_embed/eval')
 
 # Where to save the outputs of your experiments
 tf.app.flags.DEFINE_string('model_dir', '/home/tldr/Projects/models/current/VAE-LSTM/results/', 'Directory to store all the outputs(logs/checkpoints/etc). Must be provided for eval and predict mode(s)')
 tf.app.flags.DEFINE_string('exp_name', '', 'Name of the experiment. Results dir will have this name')
 
 # Hyperparameters
-tf.app.flags.DEFINE_integer('train_iterations', 600000,'the number of training iterations to perform')
+tf.app.flags.DEFINE_integer('train_iterations', 600000,'the number of training iterations(optimizer updates) to perform')
 tf.app.flags.DEFINE_integer('batch_size', 32, 'size of the mini batches of data')
 tf.app.flags.DEFINE_integer('emb_dim', 300, 'dimension of the word embeddings')
 tf.app.flags.DEFINE_integer('hidden_dim', 600, 'size of the RNN hidden states')
 tf.app.flags.DEFINE_integer('latent_dim', 1100, 'size of the latent space')
 tf.app.flags.DEFINE_integer('dec_layers', 2, 'number of layers for the decoder')
 tf.app.flags.DEFINE_integer('beam_size', 10, 'beam size for beam search decoding')
+tf.app.flags.DEFINE_string('decode_strategy', 'beam', 'default decoding strategy for predict. beam, greedy(argmax) or sample(temperature/top_k sampling)')
+tf.app.flags.DEFINE_string('export_beam_widths', '', 'comma separated beam widths exported as extra beam_<width> signatures next to beam_size')
+tf.app.flags.DEFINE_float('sample_temperature', 1.0, 'softmax temperature for the sample decoding strategy')
+tf.app.flags.DEFINE_integer('sample_top_k', 0, 'only sample from the top k tokens for the sample decoding strategy. 0 samples from the whole vocab')
+tf.app.flags.DEFINE_integer('num_samples', 1, 'number of latent samples(paraphrases) decoded for every sentence in predict mode. Outputs are grouped by sentence')
 tf.app.flags.DEFINE_integer('max_dec_steps', 200, 'max time steps allowed for decoding')
 tf.app.flags.DEFINE_float('lr', 0.00005, 'the learning rate')
+tf.app.flags.DEFINE_integer('accum_steps', 1, 'number of batches whose gradients are averaged for every optimizer update. The effective batch size is batch_size*accum_steps')
 tf.app.flags.DEFINE_float('keep_prob', 0.7, '1 - dropout rate')
 tf.app.flags.DEFINE_boolean('use_wdrop', False, 'Use word dropout as described in arxiv 1511.06349')
+tf.app.flags.DEFINE_string('cell_backend', 'basic', 'LSTM implementation. basic(LSTMCell), block(LSTMBlockCell) or fused(LSTMBlockFusedCell encoders and LSTMBlockCell decoder)')
+tf.app.flags.DEFINE_string('projection', 'full', 'output projection of the decoder. full(hidden_dim x vsize), tied(hidden_dim x emb_dim bottleneck times the embedding) or low_rank(hidden_dim x rank times rank x vsize)')
+tf.app.flags.DEFINE_integer('projection_rank', 128, 'inner dimension of the low_rank output projection')
+tf.app.flags.DEFINE_integer('softmax_samples', 0, 'number of classes sampled for the sampled softmax training loss. 0 uses the full softmax')
+
+# Evaluation
+tf.app.flags.DEFINE_integer('eval_batches', 0, 'number of eval_path batches evaluated(always the same ones). 0 evaluates the whole file once')
+tf.app.flags.DEFINE_integer('checkpoint_steps', 1000, 'save a checkpoint every checkpoint_steps training steps')
+tf.app.flags.DEFINE_boolean('inline_eval', True, 'evaluate during training. Disable it to train without interruptions and run --mode=eval --eval_watch next to it. Distributed runs(TF_CONFIG) only evaluate on an evaluator task and ignore it')
+tf.app.flags.DEFINE_integer('eval_delay_secs', 120, 'seconds before the first evaluation during training')
+tf.app.flags.DEFINE_integer('eval_throttle_secs', 600, 'minimum seconds between two evaluations during training')
+tf.app.flags.DEFINE_boolean('eval_watch', False, 'in eval mode, keep evaluating the new checkpoints of model_dir until train_iterations is reached')
+tf.app.flags.DEFINE_integer('eval_timeout', 3600, 'seconds eval_watch waits for a new checkpoint before stopping')
+
+# Instrumentation
+tf.app.flags.DEFINE_integer('throughput_every', 100, 'log the step time, input wait, examples/sec, tokens/sec and padding every n steps to TensorBoard and model_dir/throughput.jsonl. 0 disables it')
+
+# Distributed training(set TF_CONFIG, see src/utils/local_cluster.py)
+tf.app.flags.DEFINE_integer('intra_op_threads', 0, 'threads used inside an op. 0 lets tensorflow decide, set it when running several processes on one machine')
+tf.app.flags.DEFINE_integer('inter_op_threads', 0, 'ops run in parallel. 0 lets tensorflow decide')
+
+# Input pipeline
+tf.app.flags.DEFINE_string('bucket_boundaries', '', "Batch examples by length. Comma separated boundaries(e.g 10,15,20), 'auto' to derive them from the data or empty to disable")
+tf.app.flags.DEFINE_integer('num_buckets', 5, "number of length buckets when bucket_boundaries is 'auto'")
+tf.app.flags.DEFINE_boolean('packed_records', False, 'The tf.Record files were written in the packed format(one feature per sequence)')
+tf.app.flags.DEFINE_integer('shuffle_buffer', 10000, 'number of examples in the shuffle buffer of the input pipeline')
+tf.app.flags.DEFINE_integer('num_parallel_calls', -1, 'number of examples parsed in parallel. -1 autotunes it')
+
+# Predict mode
+tf.app.flags.DEFINE_string('predict_path', '', 'File the paraphrases are written to in predict mode. Defaults to the data_path without its extension + .pred.txt')
+
+# Encode mode
+tf.app.flags.DEFINE_string('encode_path', '', 'Prefix of the .npy files written in encode mode. Defaults to the data_path without its extension')
+tf.app.flags.DEFINE_string('encode_outputs', 'mu', 'comma separated posterior outputs saved in encode mode(mu, sigma and z). Each one is saved to <encode_path>.<output>.npy')
+
+# Quantize mode
+tf.app.flags.DEFINE_integer('quantize_min_size', 1024, 'weights with fewer elements are not quantized to int8')
+tf.app.flags.DEFINE_integer('quantize_eval_batches', 50, 'number of eval_path batches to compare the float32 and int8 models on')
+
+# Profile mode
+tf.app.flags.DEFINE_string('profile_target', 'train', 'what to profile. train(data_path), eval(eval_path) or predict(data_path is a text file)')
+tf.app.flags.DEFINE_integer('profile_warmup', 10, 'number of steps before tracing')
+tf.app.flags.DEFINE_integer('profile_steps', 5, 'number of traced steps')
+tf.app.flags.DEFINE_string('profile_dir', '', 'Dir for the Chrome traces and op tables. Defaults to model_dir/profile')
 
 # Debugging
 tf.app.flags.DEFINE_boolean('debug', False, "Run in tensorflow's debug mode")
 
-def infer(model, ds, vocab, checkpoint_path=None):
-    """ Runs a saved model in inference mode
+def get_bucket_boundaries(ds, path, hps):
+    """ Returns the bucket boundaries for the input fn from the bucket_boundaries hp(flag or hps.yaml)
+    """
+    if not hps.bucket_boundaries:
+        return None
+    elif hps.bucket_boundaries == 'auto':
+        return ds.length_boundaries(path, num_buckets=hps.num_buckets, packed=FLAGS.packed_records)
+    else:
+        return [int(b) for b in str(hps.bucket_boundaries).split(',')]
+
+def get_worker_shard(config):
+    """ Returns the number of training workers(the chief included) and the index of this one from the RunConfig
     """
-    # get the embedding matrix
-    emb_init = vocab.read_embeddings(FLAGS.embed_path)
+    if config.task_type == 'chief':
+        return config.num_worker_replicas, 0
+    elif config.task_type == 'worker':
+        # the chief is worker 0 if the cluster has one
+        has_chief = config.num_worker_replicas > len(config.cluster_spec.as_dict().get('worker', []))
+        return config.num_worker_replicas, config.task_id + int(has_chief)
+    return 1, 0
 
+def infer(model, ds, vocab, checkpoint_path=None):
+    """ Runs a saved model in inference mode. The paraphrases are streamed to predict_path as they are decoded
+    Returns:
+        The number of decoded sentences
+    """
     # get config
     if FLAGS.debug:
         sess_config = tf.ConfigProto(log_device_placement=False, allow_soft_placement=True)
@@ -72,7 +148,7 @@ def infer(model, ds, vocab, checkpoint_path=None):
         model_fn=model.model_fn,
         model_dir=FLAGS.model_dir,
         config=config,
-        params={'embedding_initializer': emb_init})
+        params={})
 
 
     input_fn = ds.predict_input_fn(path=FLAGS.data_path, batch_size=FLAGS.batch_size)
@@ -80,17 +156,65 @@ def infer(model, ds, vocab, checkpoint_path=None):
 
     vocab.make_reverse_vocab()
 
-    for ex in predictions:
-        print(vocab.ids_to_text(ex['pred']))
-    
-    return list(predictions)
+    predict_path = FLAGS.predict_path or os.path.splitext(FLAGS.data_path)[0] + '.pred.txt'
+    num_sents = 0
+    with open(predict_path, 'w') as f:
+        for ex in predictions:
+            # every output holds the num_samples paraphrases of one sentence
+            for sample in [dict(zip(ex, vals)) for vals in zip(*ex.values())]:
+                if 'beams' in sample:
+                    # beam search returns every beam with its log probability
+                    for beam, score in zip(sample['beams'], sample['scores']):
+                        f.write("%.4f\t%s\n" % (score, vocab.ids_to_text(beam)))
+                    f.write("\n")
+                else:
+                    f.write(vocab.ids_to_text(sample['pred']) + "\n")
+            num_sents += 1
+
+    print("Wrote the paraphrases of %d sentences to %s" % (num_sents, predict_path))
+    return num_sents
+
+def encode(model, ds, vocab, checkpoint_path=None):
+    """ Embeds every sentence of a text file with the posterior of the source encoder. The outputs are streamed into
+    float32 .npy files, row i holds sentence i
+    """
+    sess_config = tf.ConfigProto(allow_soft_placement=True)
+    sess_config.gpu_options.allow_growth = True #pylint: disable=E1101
+    config = tf.estimator.RunConfig(model_dir=FLAGS.model_dir, session_config=sess_config)
+
+    # the encoder restores the embeddings from the checkpoint, so they don't have to be read
+    estimator = tf.estimator.Estimator(
+        model_fn=model.encode_fn,
+        model_dir=FLAGS.model_dir,
+        config=config,
+        params={})
+
+    # count the sentences(without the header) to size the files
+    with open(FLAGS.data_path) as f:
+        num_sents = max(sum(1 for _ in f) - 1, 0)
+
+    prefix = FLAGS.encode_path or os.path.splitext(FLAGS.data_path)[0]
+    outputs = FLAGS.encode_outputs.split(',')
+    arrays = {out: np.lib.format.open_memmap('%s.%s.npy' % (prefix, out), mode='w+', dtype=np.float32, shape=(num_sents, model._hps.latent_dim))
+              for out in outputs}
+
+    input_fn = ds.predict_input_fn(path=FLAGS.data_path, batch_size=FLAGS.batch_size)
+    start = 0
+    for batch in estimator.predict(input_fn=input_fn, predict_keys=outputs, checkpoint_path=checkpoint_path, yield_single_examples=False):
+        end = start + len(batch[outputs[0]])
+        for out in outputs:
+            arrays[out][start:end] = batch[out]
+        start = end
+
+    for out in outputs:
+        arrays[out].flush()
+        print("Saved %d vectors to %s.%s.npy" % (start, prefix, out))
+
+    return arrays
 
 def eval(model, ds, vocab):
     """ Runs the eval loop
     """
-    # get the embedding matrix
-    emb_init = vocab.read_embeddings(FLAGS.embed_path)
-
     # get config
     if FLAGS.debug:
         sess_config = tf.ConfigProto(log_device_placement=False, allow_soft_placement=True)
@@ -107,56 +231,225 @@ def eval(model, ds, vocab):
         model_fn=model.model_fn,
         model_dir=FLAGS.model_dir,
         config=config,
-        params={'embedding_initializer': emb_init})
-
-    result = estimator.evaluate(input_fn=lambda:ds.train_input_fn(FLAGS.eval_path, FLAGS.batch_size))
-
-    print(result)
+        params={})
+
+    input_fn = lambda:ds.eval_input_fn(FLAGS.eval_path, FLAGS.batch_size, packed=FLAGS.packed_records, num_batches=FLAGS.eval_batches, num_parallel_calls=model._hps.num_parallel_calls)
+    if not FLAGS.eval_watch:
+        result = estimator.evaluate(input_fn=input_fn, checkpoint_path=FLAGS.checkpoint_path or None)
+        print(result)
+        return result
+
+    # run next to the trainer(--noinline_eval) and evaluate every checkpoint it writes, until the last one. The
+    # exporter runs here too, so the best models are exported like with inline eval
+    exporter = best_exporter()
+    export_path = os.path.join(estimator.model_dir, 'export', exporter.name)
+    result = None
+    for checkpoint_path in tf.contrib.training.checkpoints_iterator(FLAGS.model_dir, timeout=FLAGS.eval_timeout):
+        result = estimator.evaluate(input_fn=input_fn, checkpoint_path=checkpoint_path)
+        print(result)
+        done = result['global_step'] >= FLAGS.train_iterations
+        exporter.export(estimator, export_path, checkpoint_path, result, done)
+        if done:
+            break
+
+    if result is None:
+        tf.logging.warning('No new checkpoint in %s within %d secs, nothing was evaluated', FLAGS.model_dir, FLAGS.eval_timeout)
+    return result
 
 
 def train_and_eval(model, ds, vocab):
     """ Runs train and eval simultaneously
     """
-    # get the embedding matrix
-    emb_init = vocab.read_embeddings(FLAGS.embed_path)
-
-    # TODO: enable mirrored distribution strategy
-    #distribute = tf.contrib.distribute.MirroredStrategy()
+    # the pretrained embeddings are only read if training starts without a checkpoint
+    emb_init = lambda: vocab.read_embeddings(FLAGS.embed_path, cache_dir=FLAGS.model_dir)
 
     # get config
     if FLAGS.debug:
         sess_config = tf.ConfigProto(log_device_placement=True, allow_soft_placement=True)
     else:
-        sess_config = tf.ConfigProto(allow_soft_placement=True)
+        sess_config = tf.ConfigProto(allow_soft_placement=True,
+                                     intra_op_parallelism_threads=FLAGS.intra_op_threads,
+                                     inter_op_parallelism_threads=FLAGS.inter_op_threads)
     sess_config.gpu_options.allow_growth = True #pylint: disable=E1101
     sess_config.gpu_options.per_process_gpu_memory_fraction = 0.9 #pylint: disable=E1101
+
+    # in distributed training(TF_CONFIG is set) the workers only talk to the parameter servers and not to each other
+    task = json.loads(os.environ.get('TF_CONFIG', '{}')).get('task', {})
+    if task.get('type') in ('chief', 'worker'):
+        sess_config.device_filters.extend(['/job:ps', '/job:%s/task:%d' % (task['type'], task['index'])]) #pylint: disable=E1101
+
     config = tf.estimator.RunConfig(model_dir=FLAGS.model_dir,
                                     save_summary_steps=100,
-                                    save_checkpoints_steps=100,
+                                    save_checkpoints_steps=FLAGS.checkpoint_steps,
                                     session_config=sess_config)
+    num_workers, worker_index = get_worker_shard(config)
+
+    # every worker logs its throughput, only the chief writes it to TensorBoard
+    params = {'embedding_initializer': emb_init}
+    if FLAGS.throughput_every:
+        params['throughput_log'] = os.path.join(FLAGS.model_dir, 'throughput.jsonl' if worker_index == 0 else 'throughput-worker%d.jsonl' % worker_index)
+        params['throughput_every'] = FLAGS.throughput_every
+        params['throughput_summaries'] = worker_index == 0
 
     # make estimator
     estimator = tf.estimator.Estimator(
         model_fn=model.model_fn,
         model_dir=FLAGS.model_dir,
         config=config,
-        params={'embedding_initializer': emb_init}
+        params=params
     )
 
     # make the BestExporter
-    spec = {
-        "source_len": tf.FixedLenFeature([], dtype=tf.int64),
-        "source_seq": tf.VarLenFeature(dtype=tf.int64)
-    }
-    serving_input_fn = tf.estimator.export.build_parsing_serving_input_receiver_fn(feature_spec=spec)
-    exporter = tf.estimator.BestExporter(name='best_exporter', serving_input_receiver_fn=serving_input_fn, exports_to_keep=5)
+    exporter = best_exporter()
 
     # call the train_and_evaluate method
-    train_spec = tf.estimator.TrainSpec(input_fn=lambda:ds.train_input_fn(FLAGS.data_path, FLAGS.batch_size), max_steps=FLAGS.train_iterations)
-    eval_spec = tf.estimator.EvalSpec(input_fn=lambda:ds.train_input_fn(FLAGS.eval_path, FLAGS.batch_size), exporters=exporter, start_delay_secs=0, throttle_secs=0)
+    boundaries = get_bucket_boundaries(ds, FLAGS.data_path, model._hps)
+    train_spec = tf.estimator.TrainSpec(input_fn=lambda:ds.train_input_fn(FLAGS.data_path, FLAGS.batch_size, bucket_boundaries=boundaries, packed=FLAGS.packed_records, shuffle_buffer=model._hps.shuffle_buffer, num_parallel_calls=model._hps.num_parallel_calls, num_workers=num_workers, worker_index=worker_index), max_steps=FLAGS.train_iterations)
+    if not FLAGS.inline_eval and not config.cluster_spec:
+        # only train, a sidecar process(--mode=eval --eval_watch) evaluates the checkpoints. Distributed runs always
+        # go through train_and_evaluate, which starts the servers and only evaluates on an evaluator task
+        estimator.train(input_fn=train_spec.input_fn, max_steps=FLAGS.train_iterations)
+        return
+
+    # evaluates a new checkpoint at most every eval_throttle_secs
+    eval_spec = tf.estimator.EvalSpec(input_fn=lambda:ds.eval_input_fn(FLAGS.eval_path, FLAGS.batch_size, packed=FLAGS.packed_records, num_batches=FLAGS.eval_batches, num_parallel_calls=model._hps.num_parallel_calls),
+                                      steps=None, exporters=exporter, start_delay_secs=FLAGS.eval_delay_secs, throttle_secs=FLAGS.eval_throttle_secs)
 
     tf.estimator.train_and_evaluate(estimator, train_spec, eval_spec)
 
+def quantize(model, ds, vocab, checkpoint_path=None):
+    """ Exports the predict graph of a checkpoint in float32 and with int8 weights. Both are compared on the eval data
+    and the report is saved next to the exports
+    """
+    # a fixed seed so that both models draw the same samples of z
+    sess_config = tf.ConfigProto(allow_soft_placement=True)
+    config = tf.estimator.RunConfig(model_dir=FLAGS.model_dir, tf_random_seed=1234, session_config=sess_config)
+    estimator = tf.estimator.Estimator(model_fn=model.model_fn, model_dir=FLAGS.model_dir, config=config, params={})
+
+    checkpoint_path = checkpoint_path or tf.train.latest_checkpoint(FLAGS.model_dir)
+    export_base = os.path.join(FLAGS.model_dir, 'export', 'quantized')
+    float_dir = estimator.export_savedmodel(os.path.join(export_base, 'float'), parsing_serving_input_fn(), checkpoint_path=checkpoint_path)
+    float_dir = float_dir.decode() if isinstance(float_dir, bytes) else float_dir
+    version = os.path.basename(float_dir)
+    int8_dir = quantize_saved_model(float_dir, os.path.join(export_base, 'int8', version), FLAGS.quantize_min_size)
+
+    # the eval graph runs with the weights rounded like the int8 export to get its loss
+    os.makedirs(os.path.join(export_base, 'int8_ckpt', version))
+    int8_checkpoint = fake_quantize_checkpoint(checkpoint_path, os.path.join(export_base, 'int8_ckpt', version, 'model.ckpt'), FLAGS.quantize_min_size)
+
+    # take the eval batches once so that both exports decode the same sentences
+    vocab.make_reverse_vocab()
+    batches = []
+    with tf.Graph().as_default():
+        next_batch = ds.eval_input_fn(FLAGS.eval_path, FLAGS.batch_size, packed=FLAGS.packed_records, num_batches=FLAGS.quantize_eval_batches).make_one_shot_iterator().get_next()
+        with tf.Session() as sess:
+            while True:
+                try:
+                    features, labels = sess.run(next_batch)
+                except tf.errors.OutOfRangeError:
+                    break
+                examples = [tf.train.Example(features=tf.train.Features(feature={
+                    "source_seq": tf.train.Feature(int64_list=tf.train.Int64List(value=seq[:seq_len])),
+                    "source_len": tf.train.Feature(int64_list=tf.train.Int64List(value=[seq_len]))})).SerializeToString()
+                            for seq, seq_len in zip(features["source_seq"], features["source_len"])]
+                batches.append((examples, [vocab.ids_to_text(tgt).split() for tgt in labels["decoder_tgt"]]))
+
+    report = {}
+    for name, export_dir, ckpt in [('float32', float_dir, checkpoint_path), ('int8', int8_dir, int8_checkpoint)]:
+        result = estimator.evaluate(input_fn=lambda:ds.eval_input_fn(FLAGS.eval_path, FLAGS.batch_size, packed=FLAGS.packed_records, num_batches=FLAGS.quantize_eval_batches),
+                                    checkpoint_path=ckpt, name=name)
+
+        # resident memory grows by the size of the loaded model
+        rss = rss_mb()
+        predictor = tf.contrib.predictor.from_saved_model(export_dir)
+        rss = rss_mb() - rss
+
+        hyps, refs, latency = [], [], 0.0
+        for examples, targets in batches:
+            start = time.time()
+            preds = predictor({"examples": examples})["pred"]
+            latency += time.time() - start
+            hyps.extend(vocab.ids_to_text(pred[0]).split() for pred in preds) # the first sample of every sentence
+            refs.extend([tgt] for tgt in targets)
+
+        report[name] = {'loss': float(result['loss']),
+                        'bleu': corpus_bleu(refs, hyps),
+                        'ms_per_batch': 1000.0*latency/len(batches),
+                        'rss_mb': rss,
+                        'size_mb': saved_model_size(export_dir)/2.0**20,
+                        'export_dir': export_dir}
+
+    with open(os.path.join(export_base, 'report-%s.json' % version), 'w') as f:
+        json.dump(report, f, indent=2)
+    for name, stats in report.items():
+        print("%-8s loss=%.4f bleu=%.4f latency=%.1fms/batch rss=%.1fMB size=%.1fMB" % (name, stats['loss'], stats['bleu'], stats['ms_per_batch'], stats['rss_mb'], stats['size_mb']))
+
+    return report
+
+def profile(model, ds, vocab):
+    """ Profiles train, eval or predict steps on the data. After some warm up steps every step is traced, saved as a
+    Chrome trace and added to the tables of time and memory per op and per scope
+    """
+    profile_dir = FLAGS.profile_dir or os.path.join(FLAGS.model_dir, 'profile')
+    if not os.path.exists(profile_dir):
+        os.makedirs(profile_dir)
+
+    with tf.Graph().as_default():
+        if FLAGS.profile_target == 'train':
+            features, labels = ds.train_input_fn(FLAGS.data_path, FLAGS.batch_size, bucket_boundaries=get_bucket_boundaries(ds, FLAGS.data_path, model._hps), packed=FLAGS.packed_records,
+                                                 shuffle_buffer=model._hps.shuffle_buffer, num_parallel_calls=model._hps.num_parallel_calls).make_one_shot_iterator().get_next()
+            spec = model.model_fn(features, labels, tf.estimator.ModeKeys.TRAIN, params={})
+            fetches = spec.train_op
+        elif FLAGS.profile_target == 'eval':
+            features, labels = ds.eval_input_fn(FLAGS.eval_path, FLAGS.batch_size, packed=FLAGS.packed_records).repeat().make_one_shot_iterator().get_next()
+            fetches = model.model_fn(features, labels, tf.estimator.ModeKeys.EVAL, params={}).loss
+        elif FLAGS.profile_target == 'predict':
+            features = ds.predict_input_fn(FLAGS.data_path, batch_size=FLAGS.batch_size)().repeat().make_one_shot_iterator().get_next()
+            fetches = model.model_fn(features, None, tf.estimator.ModeKeys.PREDICT, params={}).predictions
+        else:
+            raise Exception("Invalid profile_target %s. Must be one of train/eval/predict" % FLAGS.profile_target)
+
+        with tf.Session(config=tf.ConfigProto(allow_soft_placement=True)) as sess:
+            # use the trained weights if there are any, the time per step doesn't depend on them much
+            sess.run([tf.global_variables_initializer(), tf.local_variables_initializer()])
+            checkpoint_path = FLAGS.checkpoint_path or tf.train.latest_checkpoint(FLAGS.model_dir)
+            if checkpoint_path:
+                tf.train.Saver().restore(sess, checkpoint_path)
+
+            for _ in range(FLAGS.profile_warmup):
+                sess.run(fetches)
+
+            profiler = tf.profiler.Profiler(sess.graph)
+            run_metadatas = []
+            for step in range(FLAGS.profile_steps):
+                run_metadata = tf.RunMetadata()
+                sess.run(fetches, options=tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE), run_metadata=run_metadata)
+                profiler.add_step(step, run_metadata)
+                write_chrome_trace(run_metadata, os.path.join(profile_dir, '%s-timeline-%d.json' % (FLAGS.profile_target, step)))
+                run_metadatas.append(run_metadata)
+
+    profile_ops(profiler, profile_dir, FLAGS.profile_target)
+    table = format_scope_table(scope_table(run_metadatas))
+    with open(os.path.join(profile_dir, '%s-model-scopes.txt' % FLAGS.profile_target), 'w') as f:
+        f.write(table + '\n')
+    print(table)
+    print("Saved the Chrome traces and the op tables to %s" % profile_dir)
+
+def best_exporter():
+    """ Returns the exporter that keeps the SavedModels of the 5 checkpoints with the lowest eval loss
+    """
+    return tf.estimator.BestExporter(name='best_exporter', serving_input_receiver_fn=parsing_serving_input_fn(), exports_to_keep=5)
+
+def parsing_serving_input_fn():
+    """ Returns the serving input fn of the exported models, which parses serialized tf.Examples
+    """
+    spec = {
+        "source_len": tf.FixedLenFeature([], dtype=tf.int64),
+        "source_seq": tf.VarLenFeature(dtype=tf.int64),
+        "num_samples": tf.FixedLenFeature([], dtype=tf.int64, default_value=FLAGS.num_samples)
+    }
+    return tf.estimator.export.build_parsing_serving_input_receiver_fn(feature_spec=spec)
+
 def example_serving_input_fn():
     """ The serving input function.
     """
@@ -181,8 +474,11 @@ def example_serving_input_fn():
         context_features=ex_context,
         sequence_features=ex_sequence)
 
-    receiver = {"inputs": serialized_ex}
-    features = {"source_seq": sequence["source_seq"], "source_len": context["source_len"]}
+    # number of paraphrases to decode, can be set per request
+    num_samples = tf.placeholder_with_default(tf.constant(FLAGS.num_samples, dtype=tf.int64), shape=[], name="num_samples")
+
+    receiver = {"inputs": serialized_ex, "num_samples": num_samples}
+    features = {"source_seq": sequence["source_seq"], "source_len": context["source_len"], "num_samples": num_samples}
     
     return tf.estimator.export.ServingInputReceiver(features, receiver)
 
@@ -195,14 +491,12 @@ def main(unused_argv):
 
     if FLAGS.mode == 'train':
         assert FLAGS.eval_path is not None, "Error! Eval path must be provided in 'train' mode. Use train_only for only training"
-    elif FLAGS.mode == 'predict':
-        FLAGS.batch_size=1
 
     # change model_dir to model_dir/exp_name and create dir if needed
     FLAGS.model_dir = os.path.join(FLAGS.model_dir, FLAGS.exp_name)
     if not os.path.exists(FLAGS.model_dir):
-        if FLAGS.mode == 'train' or FLAGS.mode == 'save_embed':
-            os.makedirs(FLAGS.model_dir)
+        if FLAGS.mode == 'train' or FLAGS.mode == 'save_embed' or FLAGS.mode == 'profile':
+            os.makedirs(FLAGS.model_dir, exist_ok=True) # the processes of a distributed run can race here
         else:
             raise Exception("The model_dir specified does not exist. Run in train to create it")
     elif not os.path.exists(FLAGS.vocab_path):
@@ -211,7 +505,7 @@ def main(unused_argv):
         raise Exception("Path for checkpoint does not exist")
 
     # load vocab and calculate size
-    vocab = Vocab(vocab_path=FLAGS.vocab_path)
+    vocab = Vocab(vocab_path=FLAGS.vocab_path, tokenizer=get_tokenizer(FLAGS.tokenizer))
     vsize = len(vocab.vocab)
 
     # load the dataset
@@ -219,7 +513,7 @@ def main(unused_argv):
 
     # create an hps list
     if not FLAGS.app_config or not FLAGS.model_params:
-        hp_list = ['batch_size', 'emb_dim', 'hidden_dim', 'latent_dim', 'dec_layers', 'beam_size', 'max_dec_steps', 'lr', 'keep_prob', 'use_wdrop', 'model_dir', 'vocab_path']
+        hp_list = ['batch_size', 'emb_dim', 'hidden_dim', 'latent_dim', 'dec_layers', 'beam_size', 'decode_strategy', 'export_beam_widths', 'sample_temperature', 'sample_top_k', 'num_samples', 'max_dec_steps', 'lr', 'accum_steps', 'keep_prob', 'use_wdrop', 'cell_backend', 'projection', 'projection_rank', 'softmax_samples', 'bucket_boundaries', 'num_buckets', 'shuffle_buffer', 'num_parallel_calls', 'model_dir', 'vocab_path']
         hps_dict = {}
         for key in FLAGS:
             if key in hp_list:
@@ -236,16 +530,19 @@ def main(unused_argv):
     if FLAGS.mode == 'train':
         train_and_eval(model, ds, vocab)
     elif FLAGS.mode == 'predict':
-        predictions = infer(model, ds, vocab, FLAGS.checkpoint_path)
-        print(predictions)
+        infer(model, ds, vocab, FLAGS.checkpoint_path)
+    elif FLAGS.mode == 'encode':
+        encode(model, ds, vocab, FLAGS.checkpoint_path)
     elif FLAGS.mode == 'eval':
         eval(model, ds, vocab)
+    elif FLAGS.mode == 'quantize':
+        quantize(model, ds, vocab, FLAGS.checkpoint_path)
     elif FLAGS.mode == 'save_embed':
-        _ = vocab.read_embeddings(path=FLAGS.embed_path, load_np=False)
+        _ = vocab.read_embeddings(path=FLAGS.embed_path, load_np=False, cache_dir=FLAGS.model_dir)
         print("Done saving numpy matrix")
         return
-    elif FLAGS.mode == 'debug':
-        print("debug")
+    elif FLAGS.mode == 'profile':
+        profile(model, ds, vocab)
     else:
         raise Exception("Invalid mode argument")
 
@@ -9,17 +9,103 @@ import tensorflow_probability as tfp
 from tensorflow.contrib.tensorboard.plugins import projector #pylint: disable=E0611
 from tensorflow.contrib.seq2seq.python.ops import beam_search_ops #pylint: disable=E0611
 
+from src.utils.hooks import ThroughputHook
+
 
 ds = tfp.distributions
 seq2seq = tf.contrib.seq2seq
 
 FLAGS = tf.app.flags.FLAGS
 
+class TopKSampleEmbeddingHelper(seq2seq.SampleEmbeddingHelper):
+    """ A SampleEmbeddingHelper that only samples from the top_k most likely tokens """
+    def __init__(self, embedding, start_tokens, end_token, softmax_temperature=None, top_k=0, seed=None):
+        """
+        Args:
+            embedding, start_tokens, end_token, softmax_temperature, seed: See seq2seq.SampleEmbeddingHelper
+            top_k: The number of most likely tokens to sample from. If 0, samples from the whole vocab
+        """
+        super(TopKSampleEmbeddingHelper, self).__init__(embedding, start_tokens, end_token, softmax_temperature=softmax_temperature, seed=seed)
+        self._top_k = top_k
+
+    def sample(self, time, outputs, state, name=None):
+        logits = outputs if self._softmax_temperature is None else outputs / self._softmax_temperature
+        if self._top_k:
+            # mask every logit below the k-th largest one
+            kth_logit = tf.nn.top_k(logits, self._top_k).values[:, -1:]
+            logits = tf.where(logits < kth_logit, tf.fill(tf.shape(logits), logits.dtype.min), logits)
+        return tf.to_int32(tf.multinomial(logits, 1, seed=self._seed)[:, 0])
+
+class OutputProjection(tf.layers.Layer):
+    """ Projects the decoder outputs to unnormalized logits over the vocab. full uses a dense hidden_dim x vsize kernel,
+    tied reuses the embedding matrix after a hidden_dim x emb_dim bottleneck and low_rank factorizes the kernel into
+    hidden_dim x rank and rank x vsize kernels
+    """
+    def __init__(self, vsize, kind='full', rank=None, embedding=None, name='dense', **kwargs):
+        """
+        Args:
+            vsize: The size of the vocab
+            kind: One of full/tied/low_rank
+            rank: The inner dimension for low_rank
+            embedding: The (vsize, emb_dim) embedding variable for tied
+            name: Name of the layer, the default keeps the variable names of the dense layer
+        """
+        super(OutputProjection, self).__init__(name=name, **kwargs)
+        if kind not in ('full', 'tied', 'low_rank'):
+            raise Exception("Invalid projection %s. Must be one of full/tied/low_rank" % kind)
+        if kind == 'tied' and embedding is None:
+            raise Exception("ERROR: The tied projection needs the embedding")
+        if kind == 'low_rank' and not rank:
+            raise Exception("ERROR: The low_rank projection needs a rank")
+        self._vsize = vsize
+        self._kind = kind
+        self._rank = rank
+        self._embedding = embedding
+
+    def build(self, input_shape):
+        input_dim = input_shape[-1].value
+        if self._kind == 'full':
+            self.kernel = self.add_variable('kernel', [input_dim, self._vsize], dtype=self.dtype)
+        elif self._kind == 'tied':
+            self.bottleneck_kernel = self.add_variable('bottleneck_kernel', [input_dim, self._embedding.shape[1].value], dtype=self.dtype)
+        else:
+            self.bottleneck_kernel = self.add_variable('bottleneck_kernel', [input_dim, self._rank], dtype=self.dtype)
+            self.kernel = self.add_variable('kernel', [self._rank, self._vsize], dtype=self.dtype)
+        self.built = True
+
+    def columns(self, ids):
+        """ Gathers the (dim, len(ids)) weights that make the logits of ids from the bottleneck outputs(for the sampled
+        softmax), without touching the weights of the other tokens
+        Args:
+            ids: 1D `Tensor` of token IDs
+        """
+        if self._kind == 'tied':
+            return tf.transpose(tf.gather(self._embedding, ids))
+        return tf.gather(self.kernel, ids, axis=1)
+
+    def bottleneck(self, inputs):
+        """ Applies the first kernel of tied/low_rank to inputs of shape (N, input_dim). The identity for full """
+        if self._kind == 'full':
+            return inputs
+        return tf.matmul(inputs, self.bottleneck_kernel)
+
+    def call(self, inputs):
+        flat = tf.reshape(inputs, [-1, inputs.shape[-1].value])
+        if self._kind == 'tied':
+            logits = tf.matmul(self.bottleneck(flat), self._embedding, transpose_b=True)
+        else:
+            logits = tf.matmul(self.bottleneck(flat), self.kernel)
+        return tf.reshape(logits, tf.concat([tf.shape(inputs)[:-1], [self._vsize]], 0))
+
+    def compute_output_shape(self, input_shape):
+        return tf.TensorShape(input_shape)[:-1].concatenate(self._vsize)
+
 class RVAE(object):
     """ Builds the model graph for different modes(train, eval, predict) """
     def __init__(self, hps, vocab_size):
         self._hps = hps # contains all hps for the model
         self._vsize = vocab_size
+        self._predict_layers = None # decoder layers shared by the decoding strategies in PREDICT mode
 
     def _embedding_layer(self, vis=False):
         """ Adds the embedding layer that is used for the encoder and decoder inputs
@@ -57,12 +143,12 @@ class RVAE(object):
         projector.visualize_embeddings(summary_writer, config)
 
     def _embedding_helper(self, input, z, mode):
-        """ A helper for beam search decoding during predict mode
+        """ A helper for embedding the sampled/decoded ids during eval and predict mode
         Args:
-            input: A vector `Tensor` of shape (batch_size, beam_size) but batch_size should be 1 for predict calls
+            input: A `Tensor` of shape (batch_size,) or (batch_size, beam_width) for beam search
             z: `Tensor` of shape (batch_size, latent_dim) used for concatonating output with sample
         Returns:
-            next_dec_input: `Tensor` of shape (batch_size, beam_size, emb_dim+latent_dim)
+            next_dec_input: `Tensor` of shape (batch_size, emb_dim+latent_dim) or (batch_size, beam_width, emb_dim+latent_dim)
         """
         if tf.get_variable_scope().name == 'decoder':
             # this is a hack to prevent a checkpoint not found error during prediction mode
@@ -71,55 +157,87 @@ class RVAE(object):
         else:
             emb_word = tf.nn.embedding_lookup(self._embedding, input)
 
-        if mode == tf.estimator.ModeKeys.EVAL:
-            next_dec_input = tf.concat([emb_word,z],-1)
-        elif mode == tf.estimator.ModeKeys.PREDICT:
-            temp = tf.tile(tf.expand_dims(z, 1), [1,self._hps.beam_size,1])
+        if mode == tf.estimator.ModeKeys.TRAIN:
+            temp = tf.zeros([0,self._hps.latent_dim]) # used in training to spoof a value for embeddinghelper
             next_dec_input = tf.concat([emb_word,temp],-1)
-        else:
-            temp = tf.zeros([0,1100]) # used in training to spoof a value for embeddinghelper
+        elif input.shape.ndims == 2:
+            # beam search feeds (batch_size, beam_width) ids
+            temp = tf.tile(tf.expand_dims(z, 1), [1,tf.shape(input)[1],1])
             next_dec_input = tf.concat([emb_word,temp],-1)
+        else:
+            next_dec_input = tf.concat([emb_word,z],-1)
 
         return next_dec_input
 
-    def _word_dropout(self, seq, len, keep_prob):
+    def _word_dropout(self, seq, seq_len, keep_prob):
         """ Creates modified decoder input that has some words in the train input replaced with the UNK token(id==3)
         Args:
-            seq: `Tensor` of shape (max_dec_seq_len,) containing a sequence for one batch entry
-            len: `Tensor` containing the sequence length for a batch entry
+            seq: `Tensor` of shape (batch_size, max_dec_seq_len) containing the decoder input sequences
+            seq_len: `Tensor` of shape (batch_size,) containing the sequence lengths
             keep_prob: `float` used to determine the amount of tokens to keep
         Returns:
-            A tensor with the same shape as dec_inputs with certain tokens in each batch_size replaced with UNK
-            according to some keep_prob
+            A tensor with the same shape as seq with every token before seq_len independently replaced with UNK
+            with probability 1-keep_prob. Padding is left untouched
         """
         with tf.variable_scope('word_dropout'):
-            # cast inputs to int64
-            seq = tf.cast(seq, dtype=tf.int32)
-            len = tf.cast(len, dtype=tf.int32)
-
-            # draw Bernoulli distribution
-            p = tf.distributions.Bernoulli(probs=keep_prob)
-
-            # sample distribution
-            sub_mask = p.sample(len) # shape (len) of independant Bernoulli trials
-            d_mask = tf.concat([sub_mask, tf.zeros(tf.size(seq)-len, dtype=tf.int32)], 0) #dropout mask
-            d_mask = tf.multiply(seq, d_mask) # set all to-be-changed indices to 0
+            # one Bernoulli trial for every token of the batch
+            in_seq = tf.sequence_mask(seq_len, tf.shape(seq)[1])
+            drop = tf.logical_and(in_seq, tf.random_uniform(tf.shape(seq)) >= keep_prob)
 
-            # get the indices with 0
-            indices = tf.reshape(tf.where(tf.equal(sub_mask, 0)), [-1,1]) # get indices of 0 positions
-            indices = tf.cast(indices, tf.int32) # cast to tf.int32 for op compatibility
-            values = tf.fill([tf.size(indices)], 3) # get tensor of same shape of indices
+            seq = tf.where(drop, tf.fill(tf.shape(seq), tf.constant(3, dtype=seq.dtype)), seq)
 
-            seq = tf.scatter_nd(indices=indices, updates=values, shape=tf.shape(seq)) # create inverse mask(all zeroes except for the idx(s) to replace)
+        return seq
 
-            # add mask back to the inv_mask
-            seq = tf.add(d_mask, seq)
-
-            # cast outputs back to tf.int64
-            seq = tf.cast(seq, dtype=tf.int64)
-            len = tf.cast(len, dtype=tf.int64)
+    def _lstm_cell(self, hidden_dim):
+        """ Makes an LSTM cell for the cell_backend hp. The block cell runs every timestep as one op and uses the same
+        variables as the LSTMCell, so checkpoints work with every backend
+        Args:
+            hidden_dim: `int`, size of the hidden dimension for the LSTMCell
+        Returns:
+            An RNNCell
+        """
+        if self._hps.cell_backend in ('block', 'fused'):
+            return tf.contrib.rnn.LSTMBlockCell(hidden_dim)
+        elif self._hps.cell_backend == 'basic':
+            return tf.nn.rnn_cell.LSTMCell(hidden_dim, state_is_tuple=True)
+        else:
+            raise Exception("Invalid cell_backend %s. Must be one of basic/block/fused" % self._hps.cell_backend)
 
-        return (seq, len)
+    def _bidirectional_lstm(self, input, seq_len, hidden_dim, initial_state_fw=None, initial_state_bw=None):
+        """ Runs a bidirectional LSTM over the input. With the fused cell_backend the whole sequence is a single op
+        per direction. Its variables are named like the ones of bidirectional_dynamic_rnn for checkpoint compatibility
+        Args:
+            input: `Tensor`, input tensor of shape (batch_size, max_seq_len, emb_dim)
+            seq_len: `Tensor` of (batch_size,)
+            hidden_dim: `int`, size of the hidden dimension for the LSTMCell
+            initial_state_fw, initial_state_bw: Optional initial `LSTMStateTuple`s of both directions
+        Returns:
+            fw_state, bw_state: Final `LSTMStateTuple`s of both directions with shape (batch_size, hidden_dim)
+        """
+        if self._hps.cell_backend == 'fused':
+            with tf.variable_scope('bidirectional_rnn'):
+                # the fused cells are time major
+                input = tf.transpose(input, [1, 0, 2])
+                seq_len = tf.to_int32(seq_len)
+                with tf.variable_scope('fw'):
+                    cell_fw = tf.contrib.rnn.LSTMBlockFusedCell(hidden_dim, name='lstm_cell')
+                    _, fw_st = cell_fw(input, initial_state=initial_state_fw, dtype=tf.float32, sequence_length=seq_len)
+                with tf.variable_scope('bw'):
+                    cell_bw = tf.contrib.rnn.TimeReversedFusedRNN(tf.contrib.rnn.LSTMBlockFusedCell(hidden_dim, name='lstm_cell'))
+                    _, bw_st = cell_bw(input, initial_state=initial_state_bw, dtype=tf.float32, sequence_length=seq_len)
+            return tf.nn.rnn_cell.LSTMStateTuple(*fw_st), tf.nn.rnn_cell.LSTMStateTuple(*bw_st)
+
+        cell_fw = self._lstm_cell(hidden_dim)
+        cell_bw = self._lstm_cell(hidden_dim)
+        (_, (fw_st, bw_st)) = tf.nn.bidirectional_dynamic_rnn(cell_fw,
+                                                              cell_bw,
+                                                              input,
+                                                              initial_state_fw=initial_state_fw,
+                                                              initial_state_bw=initial_state_bw,
+                                                              dtype=tf.float32,
+                                                              sequence_length=seq_len,
+                                                              swap_memory=True)
+        return fw_st, bw_st
 
     def _add_source_encoder(self, input, seq_len, hidden_dim):
         """ Adds a single-layer bidirectional LSTM encoder to parse the original sentence(source_seq)
@@ -131,9 +249,7 @@ class RVAE(object):
             fw_state, bw_state: Forward and backward states of the encoder with shape (batch_size, hidden_dim)
         """
         with tf.variable_scope('source_encoder'):
-            cell_fw = tf.nn.rnn_cell.LSTMCell(hidden_dim, state_is_tuple=True)
-            cell_bw = tf.nn.rnn_cell.LSTMCell(hidden_dim, state_is_tuple=True)
-            (_, (fw_st, bw_st)) = tf.nn.bidirectional_dynamic_rnn(cell_fw, cell_bw, input, dtype=tf.float32, sequence_length=seq_len, swap_memory=True)
+            fw_st, bw_st = self._bidirectional_lstm(input, seq_len, hidden_dim)
         return fw_st, bw_st
 
     def _add_target_encoder(self, input, fw_st, bw_st, seq_len, hidden_dim):
@@ -148,16 +264,7 @@ class RVAE(object):
             fwd_state, bw_state: Forward and backward states of the encoder with shape (batch_size, hidden_dim)
         """
         with tf.variable_scope('target_encoder'):
-            cell_fw = tf.nn.rnn_cell.LSTMCell(hidden_dim, state_is_tuple=True)
-            cell_bw = tf.nn.rnn_cell.LSTMCell(hidden_dim, state_is_tuple=True)
-            (_, (fw_st, bw_st)) = tf.nn.bidirectional_dynamic_rnn(cell_fw,
-                                                                  cell_bw,
-                                                                  input,
-                                                                  initial_state_fw=fw_st,
-                                                                  initial_state_bw=bw_st,
-                                                                  dtype=tf.float32,
-                                                                  sequence_length=seq_len,
-                                                                  swap_memory=True)
+            fw_st, bw_st = self._bidirectional_lstm(input, seq_len, hidden_dim, initial_state_fw=fw_st, initial_state_bw=bw_st)
         return fw_st, bw_st
 
     def _make_posterior(self, enc_state, latent_dim, initializaer):
@@ -176,7 +283,36 @@ class RVAE(object):
 
         return posterior
 
-    def _add_decoder(self, enc_state, hidden_dim, num_layers, z, keep_prob, mode, initializer, sample_prob=0.0, impute=True, train_inputs=None):
+    def _encode_outputs(self, q_z):
+        """ Returns the latent code of the source sentences from the posterior
+        Args:
+            q_z: The posterior returned by _make_posterior
+        Returns:
+            A dict of the mean(mu), standard deviation(sigma) and a sample(z) of shape (batch_size, latent_dim)
+        """
+        return {"mu": q_z.loc, "sigma": q_z.scale.diag_part(), "z": q_z.sample()}
+
+    def _repeat(self, tensor, multiplier):
+        """ Repeats every row of a tensor multiplier times, keeping the copies of a row next to each other
+        Args:
+            tensor: `Tensor` of shape (batch_size, dim)
+            multiplier: `int` or scalar `Tensor`
+        Returns:
+            `Tensor` of shape (batch_size*multiplier, dim)
+        """
+        tiled = tf.tile(tf.expand_dims(tensor, 1), [1, multiplier, 1])
+        return tf.reshape(tiled, [-1, tensor.shape[-1].value])
+
+    def _decode_strategies(self):
+        """ Returns the decoding strategies that are built in PREDICT mode, one exported signature each
+        Returns:
+            A list of (signature name, strategy, beam width) where strategy is one of beam/greedy/sample
+        """
+        beam_widths = [self._hps.beam_size] + [int(w) for w in str(self._hps.export_beam_widths).split(',') if w]
+        strategies = [('beam_%d' % w, 'beam', w) for w in sorted(set(beam_widths), key=beam_widths.index)]
+        return strategies + [('greedy', 'greedy', None), ('sample', 'sample', None)]
+
+    def _add_decoder(self, enc_state, hidden_dim, num_layers, z, keep_prob, mode, initializer, sample_prob=0.0, impute=True, train_inputs=None, strategy='beam', beam_width=None):
         """ Creates a decoder to produce outputs 
         Args: 
             enc_state: `Tensor`, Final enc_state after linear layer of shape (batch_size, hidden_dim).
@@ -193,10 +329,15 @@ class RVAE(object):
             Contains:
               enc_dec_inputs: Inputs for the decoder of shape (batch_size, max_seq_len, emb_dim)
               target_len: Length of target sequences of shape (batch_size,)
+            strategy: How to decode in PREDICT mode. beam(beam search), greedy(argmax) or sample(top_k/temperature sampling)
+            beam_width: The beam width for beam search. Defaults to the beam_size hp
         Returns:
             outputs: Differs from train/eval and predict modes
-              PREDICT: Outputs predicted_ids of (batch_size, steps_decoded[seq_len], beam_size)
+              PREDICT beam: Outputs predicted_ids of (batch_size, steps_decoded[seq_len], beam_width) and
+                the log probability of every beam of (batch_size, beam_width)
+              PREDICT greedy/sample: Outputs sample_ids of (batch_size, steps_decoded[seq_len])
               TRAIN/EVAL: Outputs logits of (batch_size, seq_len, vsize)
+              TRAIN with softmax_samples: Outputs the hidden states of (batch_size, seq_len, hidden_dim)
         """
 
         # argument validation
@@ -215,16 +356,30 @@ class RVAE(object):
             enc_dec_inputs, target_len = train_inputs
 
         with tf.variable_scope('decoder', reuse=tf.AUTO_REUSE):
-            # basic stacked RNN of 2 layers
-            dec_cells = [tf.nn.rnn_cell.LSTMCell(hidden_dim, state_is_tuple=True) for _ in range(num_layers)]
             enc_states = tuple([enc_state for _ in range(num_layers)])
-            stacked_cell = tf.nn.rnn_cell.MultiRNNCell(dec_cells, state_is_tuple=True)
-
-            if mode == tf.estimator.ModeKeys.TRAIN and not self._hps.use_wdrop:
-                stacked_cell = tf.nn.rnn_cell.DropoutWrapper(stacked_cell, input_keep_prob=keep_prob)
-
-            # add projection layer to create unnormalized logits
-            projection_layer = tf.layers.Dense(self._vsize, use_bias=False)
+            if mode == tf.estimator.ModeKeys.PREDICT and self._predict_layers is not None:
+                # the other decoding strategies share the cell and projection layer(and so their variables)
+                stacked_cell, projection_layer = self._predict_layers
+            else:
+                # basic stacked RNN of 2 layers
+                dec_cells = [self._lstm_cell(hidden_dim) for _ in range(num_layers)]
+                stacked_cell = tf.nn.rnn_cell.MultiRNNCell(dec_cells, state_is_tuple=True)
+
+                if mode == tf.estimator.ModeKeys.TRAIN and not self._hps.use_wdrop:
+                    stacked_cell = tf.nn.rnn_cell.DropoutWrapper(stacked_cell, input_keep_prob=keep_prob)
+
+                # add projection layer to create unnormalized logits
+                projection_layer = OutputProjection(self._vsize, self._hps.projection, self._hps.projection_rank, self._embedding)
+                if mode == tf.estimator.ModeKeys.PREDICT:
+                    self._predict_layers = (stacked_cell, projection_layer)
+            output_layer = projection_layer
+            if mode == tf.estimator.ModeKeys.TRAIN and self._hps.softmax_samples:
+                # the sampled loss uses the projection weights directly, so the decoder outputs its hidden states
+                # create the kernel under the same name the decoder gives it so checkpoints work in every mode
+                with tf.variable_scope('decoder'):
+                    projection_layer(tf.zeros([0, hidden_dim]))
+                output_layer = None
+            self._projection_layer = projection_layer
 
             if mode != tf.estimator.ModeKeys.PREDICT:
                 # add z to the inputs
@@ -241,37 +396,95 @@ class RVAE(object):
                 decoder = seq2seq.BasicDecoder(cell=stacked_cell,
                                                helper=helper,
                                                initial_state=enc_states,
-                                               output_layer=projection_layer)
-            else:
+                                               output_layer=output_layer)
+            elif strategy == 'beam':
+                beam_width = beam_width or self._hps.beam_size
                 decoder = seq2seq.BeamSearchDecoder(cell=stacked_cell,
                                                     embedding=lambda x: self._embedding_helper(x, z, mode),
-                                                    start_tokens=tf.fill([self._hps.batch_size], 1),
+                                                    start_tokens=tf.fill([tf.shape(z)[0]], 1),
                                                     end_token=2,
-                                                    initial_state=enc_states,
-                                                    beam_width=self._hps.beam_size,
+                                                    initial_state=seq2seq.tile_batch(enc_states, beam_width),
+                                                    beam_width=beam_width,
                                                     output_layer=projection_layer)
+            else:
+                if strategy == 'greedy':
+                    helper = seq2seq.GreedyEmbeddingHelper(embedding=lambda x: self._embedding_helper(x, z, mode),
+                                                           start_tokens=tf.fill([tf.shape(z)[0]], 1),
+                                                           end_token=2)
+                elif strategy == 'sample':
+                    helper = TopKSampleEmbeddingHelper(embedding=lambda x: self._embedding_helper(x, z, mode),
+                                                       start_tokens=tf.fill([tf.shape(z)[0]], 1),
+                                                       end_token=2,
+                                                       softmax_temperature=self._hps.sample_temperature,
+                                                       top_k=self._hps.sample_top_k)
+                else:
+                    raise Exception("Invalid decoding strategy %s. Must be one of beam/greedy/sample" % strategy)
+
+                decoder = seq2seq.BasicDecoder(cell=stacked_cell,
+                                               helper=helper,
+                                               initial_state=enc_states,
+                                               output_layer=projection_layer)
 
             # unroll the decoder
-            outputs, _, _ = seq2seq.dynamic_decode(decoder, impute_finished=impute, maximum_iterations=self._hps.max_dec_steps, scope='decoder')
+            outputs, final_state, _ = seq2seq.dynamic_decode(decoder, impute_finished=impute, maximum_iterations=self._hps.max_dec_steps, scope='decoder')
 
         if mode != tf.estimator.ModeKeys.PREDICT:
             return outputs.rnn_output
+        elif strategy == 'beam':
+            return outputs.predicted_ids, final_state.log_probs
         else:
-            return outputs.predicted_ids
+            return outputs.sample_id
+
+    def _sampled_sequence_loss(self, outputs, targets, masks):
+        """ Adds ops to calculate the sampled softmax loss of every sequence. The negative classes are drawn from a
+        log-uniform distribution, which matches the vocab because its IDs are sorted by decreasing frequency. Only the
+        projection weights of the targets and the sampled classes are gathered, so neither the logits nor the weights
+        are ever made for the whole vocab
+        Args:
+            outputs: The hidden states of the decoder. Shape (batch_size, tgt_max_seq_len, hidden_dim)
+            targets: `Tensor` of target values for the loss. Of shape (batch_size, tgt_max_seq_len)
+            masks: `Tensor` of shape (batch_size, tgt_max_seq_len) of float type representing the padding mask
+        Returns:
+            The crossentropy loss averaged over the timesteps of every sequence. Shape (batch_size,)
+        """
+        with tf.variable_scope('sampled_softmax'):
+            labels = tf.reshape(tf.cast(targets, tf.int64), [-1, 1])
+            sampled, true_expected, sampled_expected = tf.nn.log_uniform_candidate_sampler(
+                true_classes=labels, num_true=1, num_sampled=self._hps.softmax_samples, unique=True, range_max=self._vsize)
+            hidden = self._projection_layer.bottleneck(tf.reshape(outputs, [-1, self._hps.hidden_dim])) # shape (N, dim)
+
+            # logits of the targets and the sampled classes, minus the log of their expected counts(log-Q correction)
+            true_logits = tf.reduce_sum(hidden*tf.transpose(self._projection_layer.columns(labels[:, 0])), 1, keepdims=True)
+            true_logits -= tf.log(true_expected)
+            sampled_logits = tf.matmul(hidden, self._projection_layer.columns(sampled)) - tf.log(sampled_expected) # shape (N, softmax_samples)
+
+            # a sampled class that is the target isn't a negative
+            hit_rows, hit_ids, hit_weights = tf.nn.compute_accidental_hits(labels, sampled, num_true=1)
+            sampled_logits += tf.scatter_nd(tf.stack([tf.cast(hit_rows, tf.int64), hit_ids], 1), hit_weights, tf.shape(sampled_logits, out_type=tf.int64))
+
+            logits = tf.concat([true_logits, sampled_logits], 1)
+            crossent = tf.nn.sparse_softmax_cross_entropy_with_logits(labels=tf.zeros_like(labels[:, 0]), logits=logits)
+            crossent = tf.reshape(crossent, tf.shape(targets)) * masks
+
+        return tf.reduce_sum(crossent, 1) / (tf.reduce_sum(masks, 1) + 1e-12)
 
     def _calc_losses(self, q_z, p_z, logits, targets, masks, mode):
         """ Adds ops to calculate losses for training 
         Args:
             q_z: The posterior distribution for calculating KL Divergence
             p_z: The prior distribution for calculating KL Divergence
-            logits: The outputs of the decoder. Shape (batch_size, tgt_max_seq_len, vsize)
+            logits: The outputs of the decoder. Shape (batch_size, tgt_max_seq_len, vsize). If training with
+              softmax_samples, the hidden states of the decoder instead
             targets: `Tensor` of target values for the loss. Of shape (batch_size, tgt_max_seq_len)
             masks: `Tensor` of shape (batch_size, tgt_max_seq_len) of float type representing the padding mask
-            mode: If in train mode, use global_step variable for kl_coeff, otherwise set kl_coeff to 1.0 
+            mode: If in train mode, use global_step variable(the number of optimizer updates) for kl_coeff, otherwise set kl_coeff to 1.0 
         """
         with tf.variable_scope('loss'):
-            # calculate crossentropy loss (batch_size,)
-            r_loss = seq2seq.sequence_loss(logits=logits, targets=targets, weights=masks, average_across_batch=False)
+            # calculate crossentropy loss (batch_size,). The sampled loss is only an estimate used for training
+            if mode == tf.estimator.ModeKeys.TRAIN and self._hps.softmax_samples:
+                r_loss = self._sampled_sequence_loss(logits, targets, masks)
+            else:
+                r_loss = seq2seq.sequence_loss(logits=logits, targets=targets, weights=masks, average_across_batch=False)
             r_loss = tf.reduce_mean(r_loss, name='r_loss')
 
             # calculate KLD (batch_size,)
@@ -287,9 +500,11 @@ class RVAE(object):
             # calculate total loss
             loss = r_loss + kl_coeff*kl_div
 
-        # make dict for scalar summaries
+        # make dict for scalar summaries. The perplexity of the sampled loss is only an estimate, so it's tagged apart
+        sampled = mode == tf.estimator.ModeKeys.TRAIN and self._hps.softmax_samples
         summaries = {
             'loss/r_loss': r_loss,
+            'loss/sampled_perplexity' if sampled else 'loss/perplexity': tf.exp(r_loss, name='perplexity'),
             'loss/kl_loss': kl_div,
             'loss/kl_coeff': kl_coeff,
             'loss/loss': loss
@@ -298,7 +513,8 @@ class RVAE(object):
         return loss, summaries
 
     def _train_op(self, loss, lr):
-        """ Adds ops to calculate gradients and perform backprop
+        """ Adds ops to calculate gradients and perform backprop. With accum_steps > 1 the gradients of accum_steps
+        micro-batches are averaged before Adam applies them, and global_step only counts the applied updates
         Args:
             loss: The scalar loss
             lr: The learning rate
@@ -307,10 +523,55 @@ class RVAE(object):
         """
         # make optimizer
         optimizer = tf.train.AdamOptimizer(lr)
-        train_op = optimizer.minimize(loss, global_step=tf.train.get_global_step())
+        global_step = tf.train.get_global_step()
+        if self._hps.accum_steps <= 1:
+            return optimizer.minimize(loss, global_step=global_step)
+
+        grads_and_vars = [(g, v) for g, v in optimizer.compute_gradients(loss) if g is not None]
+        with tf.variable_scope('grad_accum'):
+            accums = [tf.get_variable(v.op.name, v.shape, v.dtype, tf.zeros_initializer(), trainable=False) for _, v in grads_and_vars]
+            counter = tf.get_variable('counter', [], tf.int64, tf.zeros_initializer(), trainable=False)
+
+            # sum the gradients of the micro-batch(the embedding gradients are made dense)
+            accum_ops = [acc.assign_add(tf.convert_to_tensor(g)) for acc, (g, _) in zip(accums, grads_and_vars)]
+            with tf.control_dependencies(accum_ops):
+                count = counter.assign_add(1)
+
+            def _apply():
+                """ Applies the mean gradient and resets the accumulators """
+                apply_op = optimizer.apply_gradients([(acc/self._hps.accum_steps, v) for acc, (_, v) in zip(accums, grads_and_vars)], global_step=global_step)
+                with tf.control_dependencies([apply_op]):
+                    return tf.group(*([acc.assign(tf.zeros_like(acc)) for acc in accums] + [counter.assign(0)]))
+
+            train_op = tf.cond(count >= self._hps.accum_steps, _apply, tf.no_op)
 
         return train_op
 
+    def encode_fn(self, features, labels, mode, params):
+        """ Estimator model_fn that only runs the source encoder and the posterior to embed sentences. It uses the same
+        variables as model_fn, so it restores the checkpoints written in training
+        Args:
+            features, labels, mode, params: See model_fn. Only PREDICT mode is supported
+        Returns:
+            tf.estimator.EstimatorSpec with the predictions of _encode_outputs
+        """
+        if mode != tf.estimator.ModeKeys.PREDICT:
+            raise Exception("ERROR: encode_fn only supports PREDICT mode")
+
+        self._embedding = self._embedding_layer()
+        if isinstance(features["source_seq"], tf.SparseTensor):
+            features["source_seq"] = tf.sparse_tensor_to_dense(features["source_seq"])
+        emb_src_inputs = tf.nn.embedding_lookup(self._embedding, features['source_seq'])
+
+        src_fw_st, src_bw_st = self._add_source_encoder(emb_src_inputs, features['source_len'], self._hps.hidden_dim)
+        src_enc_state = tf.concat([src_fw_st[0], src_bw_st[0]], 1) # shape (batch_size, hidden_dim*2)
+        q_z = self._make_posterior(src_enc_state, self._hps.latent_dim, tf.random_normal_initializer(stddev=0.001))
+
+        predictions = self._encode_outputs(q_z)
+        export_outputs = {'encode': tf.estimator.export.PredictOutput(predictions),
+                          tf.saved_model.signature_constants.DEFAULT_SERVING_SIGNATURE_DEF_KEY: tf.estimator.export.PredictOutput(predictions)}
+        return tf.estimator.EstimatorSpec(mode, predictions=predictions, export_outputs=export_outputs)
+
     def model_fn(self, features, labels, mode, params):
         """ Builds the graph of the model being implemented 
         Args:
@@ -318,6 +579,8 @@ class RVAE(object):
             Contains:
                 'source_seq': Source sequence of shape (batch_size, max_len_seq) where max_len_seq is the max length of a seq in a batch
                 'source_len': Source lengths of shape (batch_size,)
+                'num_samples': Optional scalar(or one per example, the max is used) that overrides the num_samples hp in predict mode.
+                The predictions always have a num_samples dimension after the batch
             labels: A Tensor or doct of Tensors to be used as labels. Should be blank for
             predict mode.
             Contains:
@@ -325,7 +588,13 @@ class RVAE(object):
                 'target_len': Target lengths of shape (batch_size,)
                 'decoder_tgt': Target sequence of (batch_size, max_len_seq). Last shape is same as target_seq
             mode: An instance of tf.estimator.ModeKeys to be used for calls to train() and evaluate()
-            params: Any additional configuration needed    
+            params: Any additional configuration needed
+            Contains:
+                'embedding_initializer': The pretrained embedding matrix or a function returning it, only used(and
+                  called) in train mode when the model starts without a checkpoint
+                'throughput_log': Optional JSONL file for the ThroughputHook in train mode
+                'throughput_every': Number of steps averaged into every throughput record
+                'throughput_summaries': Also write the throughput records to TensorBoard    
         Returns:
             tf.estimator.EstimatorSpec which is contains information the caller(i.e train(), evaluate(), predict())
             needs.
@@ -351,7 +620,7 @@ class RVAE(object):
         # modify and embed the target sequence
         if mode == tf.estimator.ModeKeys.TRAIN and self._hps.use_wdrop:
             # apply word dropout, replacing 0.3 words in decoder input with UNK token
-            dec_input,_ = tf.map_fn(lambda x: self._word_dropout(x[0], x[1], self._hps.keep_prob), (labels['target_seq'], labels['target_len']))
+            dec_input = self._word_dropout(labels['target_seq'], labels['target_len'], self._hps.keep_prob)
             emb_tgt_inputs = tf.nn.embedding_lookup(self._embedding, dec_input)
         elif mode == tf.estimator.ModeKeys.TRAIN and not self._hps.use_wdrop:
             emb_tgt_inputs = tf.nn.embedding_lookup(self._embedding, labels['target_seq'])
@@ -367,11 +636,7 @@ class RVAE(object):
         src_enc_output = tf.concat([src_fw_st[1], src_bw_st[1]], 1) # shape (batch_size, hidden_dim*2)
         dec_init_state = tf.layers.dense(src_enc_state, self._hps.hidden_dim, kernel_initializer=rand_unif_init)
         dec_init_output = tf.layers.dense(src_enc_output, self._hps.hidden_dim, kernel_initializer=rand_unif_init)
-        if mode == tf.estimator.ModeKeys.PREDICT:
-            dec_init = tf.nn.rnn_cell.LSTMStateTuple(seq2seq.tile_batch(dec_init_state, self._hps.beam_size),
-                                                        seq2seq.tile_batch(dec_init_output, self._hps.beam_size))
-        else:
-            dec_init = tf.nn.rnn_cell.LSTMStateTuple(dec_init_state, dec_init_output)
+        dec_init = tf.nn.rnn_cell.LSTMStateTuple(dec_init_state, dec_init_output) # tiled by the decoder for beam search
             
         # adds target encoder(only in train mode) and posterior distribution
         if mode != tf.estimator.ModeKeys.TRAIN:
@@ -387,7 +652,13 @@ class RVAE(object):
             q_z = self._make_posterior(train_enc_state, self._hps.latent_dim, rand_norm_init)
 
         # sample from posterior distribution
-        z = q_z.sample() # shape (batch_size, latent_dim)
+        if mode == tf.estimator.ModeKeys.PREDICT:
+            # draw num_samples z for every source(the request can override the number, even if the hp is 1) and decode them as one batch
+            num_samples = tf.cast(tf.reduce_max(features.get('num_samples', self._hps.num_samples)), tf.int32)
+            z = tf.reshape(tf.transpose(q_z.sample(num_samples), [1, 0, 2]), [-1, self._hps.latent_dim]) # shape (batch_size*num_samples, latent_dim)
+            dec_init = tf.nn.rnn_cell.LSTMStateTuple(self._repeat(dec_init[0], num_samples), self._repeat(dec_init[1], num_samples))
+        else:
+            z = q_z.sample() # shape (batch_size, latent_dim)
 
         # add the prior distribution for loss
         if mode != tf.estimator.ModeKeys.PREDICT:
@@ -419,15 +690,39 @@ class RVAE(object):
                                        train_inputs=(emb_tgt_inputs, tgt_len))
             training_logits = tf.identity(logits, name='logits')
         else:
-            predicted_ids = self._add_decoder(dec_init,
-                                              self._hps.hidden_dim,
-                                              self._hps.dec_layers,
-                                              z,
-                                              1.0,
-                                              mode,
-                                              trunc_norm_init,
-                                              impute=False)
-            inference_logits = tf.transpose(predicted_ids, perm=[2, 0, 1], name='predictions') # shape (beam_size, batch_size, seq_len)
+            # add a decoder for every strategy. They share their variables and only the requested one is run
+            strategy_preds = {}
+            self._predict_layers = None
+            for name, strategy, beam_width in self._decode_strategies():
+                with tf.name_scope(name):
+                    decoded = self._add_decoder(dec_init,
+                                                self._hps.hidden_dim,
+                                                self._hps.dec_layers,
+                                                z,
+                                                1.0,
+                                                mode,
+                                                trunc_norm_init,
+                                                impute=False,
+                                                strategy=strategy,
+                                                beam_width=beam_width)
+                    if strategy == 'beam':
+                        # every beam with its score, the beams are sorted from best to worst
+                        predicted_ids, scores = decoded
+                        beams = tf.transpose(predicted_ids, perm=[0, 2, 1]) # shape (batch_size, beam_width, seq_len)
+                        preds = {"pred": beams[:, 0], "beams": beams, "scores": scores}
+                    else:
+                        preds = {"pred": decoded}
+
+                    # group the samples by source, adding a num_samples dimension after the batch
+                    preds = {key: tf.reshape(val, tf.concat([[-1, num_samples], tf.shape(val)[1:]], 0)) for key, val in preds.items()}
+                    strategy_preds[name] = preds
+
+            default = 'beam_%d' % self._hps.beam_size if self._hps.decode_strategy == 'beam' else self._hps.decode_strategy
+            if default not in strategy_preds:
+                raise Exception("Invalid decode_strategy %s. Must be one of beam/greedy/sample" % self._hps.decode_strategy)
+            predictions = strategy_preds[default]
+            strategy_preds['encode'] = self._encode_outputs(q_z)
+            tf.identity(predictions["pred"], name='predictions') # keeps the predictions op of the graph for fetching by name
 
         # return the appropriate estimator spec
         if mode != tf.estimator.ModeKeys.PREDICT:
@@ -436,6 +731,10 @@ class RVAE(object):
             masks = tf.sequence_mask(labels['target_len'], dtype=tf.float32, name='masks')
             loss, summary = self._calc_losses(q_z, p_z, training_logits, labels['decoder_tgt'], masks, mode)
             
+            # fraction of padded tokens in the batch
+            summary['input/source_pad_frac'] = 1.0 - tf.to_float(tf.reduce_sum(features['source_len']))/tf.to_float(tf.size(features['source_seq']))
+            summary['input/target_pad_frac'] = 1.0 - tf.to_float(tf.reduce_sum(labels['target_len']))/tf.to_float(tf.size(labels['target_seq']))
+
             # add the summaries
             for n, t in summary.items():
                 tf.summary.scalar(n, t)
@@ -444,14 +743,26 @@ class RVAE(object):
             if mode == tf.estimator.ModeKeys.TRAIN:
                 train_op = self._train_op(loss, self._hps.lr)
 
-                # initialize embedding variables
+                # initialize embedding variables. Only runs when there is no checkpoint to restore
                 def init_fn(scaffold, sess):
-                    return sess.run(self._embedding.initializer, {self._embedding.initial_value: params['embedding_initializer']})
+                    emb_init = params['embedding_initializer']
+                    if callable(emb_init):
+                        emb_init = emb_init()
+                    return sess.run(self._embedding.initializer, {self._embedding.initial_value: emb_init})
 
                 scaffold = tf.train.Scaffold(init_fn=init_fn)
 
-                return tf.estimator.EstimatorSpec(mode, loss=loss, train_op=train_op, scaffold=scaffold)
+                hooks = []
+                if params.get('throughput_log'):
+                    hooks.append(ThroughputHook(features, labels, params['throughput_log'],
+                                                every_n_steps=params.get('throughput_every', 100),
+                                                write_summaries=params.get('throughput_summaries', True)))
+
+                return tf.estimator.EstimatorSpec(mode, loss=loss, train_op=train_op, scaffold=scaffold, training_hooks=hooks)
             else:
                 return tf.estimator.EstimatorSpec(mode, loss=loss)
         else:
-            return tf.estimator.EstimatorSpec(mode, predictions={"pred": inference_logits[0]})
+            # every strategy gets its own signature in the exported model, and the encode signature only runs the encoder
+            export_outputs = {name: tf.estimator.export.PredictOutput(preds) for name, preds in strategy_preds.items()}
+            export_outputs[tf.saved_model.signature_constants.DEFAULT_SERVING_SIGNATURE_DEF_KEY] = tf.estimator.export.PredictOutput(predictions)
+            return tf.estimator.EstimatorSpec(mode, predictions=predictions, export_outputs=export_outputs)
@@ -1,9 +1,11 @@
+import csv
+import json
 import os
 
 import pytest
 import tensorflow as tf
 
-from src.data.dataset import Dataset
+from src.data.dataset import Dataset, manifest_path
 from src.data.vocab import Vocab
 
 WORKING_DIR = os.path.abspath(os.path.dirname(__file__)) # path to file
@@ -18,6 +20,23 @@ def dataset():
     vocab = Vocab(VOCAB_PATH)
     return Dataset(vocab)
 
+@pytest.fixture
+def make_records(tmp_path):
+    ''' Return a function that writes sentence pairs to tf.Record files in tmp_path, returning the Dataset
+    with their vocab and the record files '''
+    def _make_records(sents, name="train", **kwargs):
+        data_path = os.path.join(str(tmp_path), "%s_data.csv" % name)
+        with open(data_path, 'w') as f:
+            csv.writer(f).writerows(sents)
+
+        vocab = Vocab()
+        for pair in sents:
+            for sent in pair:
+                vocab.prep_train_seq(sent)
+        handler = Dataset(vocab)
+        return handler, handler.dataset_to_example(data_path, os.path.join(str(tmp_path), "%s.tfrecord" % name), **kwargs)
+    return _make_records
+
 def test_train_input_fn_type(dataset):
     """ Test the handler capability to create dataset from tfrecord file format
     """
@@ -50,3 +69,144 @@ def test_train_input_fn_structure(dataset):
             assert len(features["source_len"]) == 3
             assert len(labels["target_seq"]) == 3
             assert len(labels["target_len"]) == 3
+
+def test_train_input_fn_bucketed(dataset):
+    """ Test that bucketed batches keep the batch structure and only hold examples of one bucket
+    """
+    boundaries = dataset.length_boundaries(TRAIN_RECORD, num_buckets=3)
+    ds = dataset.train_input_fn(TRAIN_RECORD, 3, bucket_boundaries=boundaries)
+    iterator = ds.make_initializable_iterator()
+    next = iterator.get_next()
+
+    with tf.Session() as sess:
+        sess.run(iterator.initializer)
+        features, labels = sess.run(next)
+        assert len(features["source_seq"]) == 3
+        assert len(labels["target_seq"]) == 3
+        lengths = [max(s, t) for s, t in zip(features["source_len"], labels["target_len"])]
+        buckets = set(sum(l >= b for b in boundaries) for l in lengths)
+        assert len(buckets) == 1
+
+def test_sharded_dataset_to_example(make_records, tmp_path):
+    """ Test that the parallel writer splits all the examples over the shards and writes a manifest
+    """
+    sents = [["a man riding a horse", "a person on a horse"], ["two dogs playing", "dogs are playing"]]*5
+    _, records = make_records(sents, num_shards=2, num_workers=2, chunk_size=3)
+
+    assert [os.path.basename(r) for r in records] == ["train-00000-of-00002.tfrecord", "train-00001-of-00002.tfrecord"]
+    with open(manifest_path(os.path.join(str(tmp_path), "train.tfrecord"))) as fp:
+        manifest = json.load(fp)
+    assert manifest["num_examples"] == len(sents)
+    assert sum(len(list(tf.python_io.tf_record_iterator(r))) for r in records) == len(sents)
+
+def test_predict_input_fn_batches(dataset, tmp_path):
+    """ Test that the predict input is streamed in batches that are padded to their own longest row
+    """
+    path = os.path.join(str(tmp_path), "predict.txt")
+    with open(path, 'w') as f:
+        f.write("sentence\na dog\na man riding a horse down the street\ntwo cats\na bird\none more\n")
+
+    next = dataset.predict_input_fn(path, batch_size=2)().make_one_shot_iterator().get_next()
+
+    with tf.Session() as sess:
+        batches = [sess.run(next) for _ in range(3)]
+        with pytest.raises(tf.errors.OutOfRangeError):
+            sess.run(next)
+
+    assert [len(b["source_len"]) for b in batches] == [2, 2, 1]
+    for batch in batches:
+        assert batch["source_seq"].shape[1] == max(batch["source_len"])
+
+@pytest.mark.parametrize("bucket_boundaries", [None, [6]])
+def test_packed_train_input_fn(make_records, bucket_boundaries):
+    """ Test that packed records are parsed into the same structure as the SequenceExample records
+    """
+    sents = [["a man riding a horse", "a person on a horse"], ["two dogs playing", "dogs are playing"]]*3
+
+    batches = []
+    for packed in [False, True]:
+        handler, records = make_records(sents, name="train-%s" % packed, packed=packed)
+        next = handler.train_input_fn(records, 3, bucket_boundaries=bucket_boundaries, packed=packed).make_one_shot_iterator().get_next()
+        with tf.Session() as sess:
+            batches.append(sess.run(next))
+
+    for (seq_features, seq_labels), (packed_features, packed_labels) in [batches]:
+        assert sorted(seq_features) == sorted(packed_features) and sorted(seq_labels) == sorted(packed_labels)
+        assert len(packed_features["source_seq"]) == 3
+        assert packed_features["source_seq"].shape[1] == max(packed_features["source_len"])
+        assert packed_labels["target_seq"].shape == packed_labels["decoder_tgt"].shape
+
+def test_record_files_patterns(dataset, tmp_path):
+    """ Test that globs, lists and comma separated paths are expanded to the record files
+    """
+    paths = [os.path.join(str(tmp_path), "train-%05d-of-00003.tfrecord" % idx) for idx in range(3)]
+    for path in paths:
+        open(path, 'w').close()
+
+    assert dataset._record_files(os.path.join(str(tmp_path), "train-*.tfrecord")) == paths
+    assert dataset._record_files(paths[:2]) == paths[:2]
+    assert dataset._record_files(",".join(paths[1:])) == paths[1:]
+    with pytest.raises(Exception):
+        dataset._record_files(os.path.join(str(tmp_path), "val-*.tfrecord"))
+
+def test_packed_manifest_mismatch(make_records, tmp_path):
+    """ Test that reading sharded records in the other format than they were written in fails early
+    """
+    sents = [["sentence number %d" % idx, "paraphrase %d" % idx] for idx in range(4)]
+    handler, records = make_records(sents, num_shards=2, packed=True)
+    record_path = os.path.join(str(tmp_path), "train.tfrecord")
+
+    assert handler._record_files(record_path, packed=True) == records
+    with pytest.raises(Exception):
+        handler.train_input_fn(record_path, 2, packed=False)
+    with pytest.raises(Exception):
+        handler.length_boundaries(record_path, packed=False)
+
+def test_length_boundaries_empty(dataset, tmp_path):
+    """ Test that deriving the boundaries from records without examples fails with a clear error
+    """
+    record_path = os.path.join(str(tmp_path), "empty.tfrecord")
+    tf.python_io.TFRecordWriter(record_path).close()
+
+    with pytest.raises(Exception, match="No examples"):
+        dataset.length_boundaries(record_path)
+
+@pytest.mark.parametrize("num_shards,num_workers", [(1, 2), (2, 2), (2, 3)])
+def test_train_input_fn_workers(make_records, num_shards, num_workers):
+    """ Test that the workers of a distributed run read different examples, with and without enough shards
+    """
+    sents = [["sentence number %d" % idx, "paraphrase %d" % idx] for idx in range(10)]
+    handler, records = make_records(sents, num_shards=num_shards)
+
+    # a batch of 10 holds every example of a worker at least twice
+    seen = []
+    for worker_index in range(num_workers):
+        next = handler.train_input_fn(records, 10, num_workers=num_workers, worker_index=worker_index).make_one_shot_iterator().get_next()
+        with tf.Session() as sess:
+            features, _ = sess.run(next)
+        seen.append(set(tuple(seq[:seq_len]) for seq, seq_len in zip(features["source_seq"], features["source_len"])))
+
+    # the workers split the examples between them
+    assert all(seen)
+    assert sum(len(s) for s in seen) == len(set.union(*seen)) == len(sents)
+
+@pytest.mark.parametrize("packed", [False, True])
+def test_eval_input_fn(make_records, packed):
+    """ Test that evaluation makes one pass over the records in the same order every time
+    """
+    sents = [["sentence number %d" % idx, "paraphrase %d" % idx] for idx in range(7)]
+    handler, records = make_records(sents, name="val", num_shards=2, packed=packed)
+
+    def _run(num_batches=None):
+        next = handler.eval_input_fn(records, 3, packed=packed, num_batches=num_batches).make_one_shot_iterator().get_next()
+        batches = []
+        with tf.Session() as sess:
+            while True:
+                try:
+                    batches.append(sess.run(next)[0]["source_len"].tolist())
+                except tf.errors.OutOfRangeError:
+                    return batches
+
+    assert [len(b) for b in _run()] == [3, 3, 1]
+    assert _run() == _run()
+    assert _run(num_batches=2) == _run()[:2]
@@ -0,0 +1,32 @@
+""" Testing the functionality located in src/utils/hooks """
+import json
+import os
+
+import numpy as np
+import tensorflow as tf
+
+from src.utils.hooks import ThroughputHook
+
+def test_throughput_hook(tmp_path):
+    """ Test that the hook writes a record every n steps with the padding of the batches """
+    seqs = np.array([[1, 5, 2, 0], [1, 6, 7, 2]]*4)
+    lens = np.array([3, 4]*4)
+    log_path = os.path.join(str(tmp_path), "throughput.jsonl")
+
+    with tf.Graph().as_default():
+        global_step = tf.train.get_or_create_global_step()
+        dataset = tf.data.Dataset.from_tensor_slices(({"source_seq": seqs, "source_len": lens}, {"target_seq": seqs, "target_len": lens}))
+        features, labels = dataset.batch(2).make_one_shot_iterator().get_next()
+        train_op = tf.assign_add(global_step, 1)
+
+        hook = ThroughputHook(features, labels, log_path, every_n_steps=2, trace_every_n_steps=1)
+        with tf.train.MonitoredSession(hooks=[hook]) as sess:
+            for _ in range(4):
+                sess.run(train_op)
+
+    with open(log_path) as f:
+        records = [json.loads(line) for line in f]
+    assert [r["global_step"] for r in records] == [2, 4]
+    for record in records:
+        assert np.isclose(record["pad_ratio"], 1.0 - 7.0/8.0)
+        assert record["examples_per_sec"] > 0 and record["input_wait_ms"] >= 0
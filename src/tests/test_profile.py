@@ -0,0 +1,26 @@
+""" Testing the functionality located in src/utils/profile """
+import pytest
+import tensorflow as tf
+
+from src.utils.profile import op_scope, scope_table
+
+@pytest.mark.parametrize("node_name,expected", [
+    ("source_encoder/bidirectional_rnn/fw/fw/while/lstm_cell/MatMul", ("source_encoder", False)),
+    ("gradients/decoder/decoder/while/BasicDecoderStep/dense/Tensordot/MatMul_grad/MatMul", ("decoder", True)),
+    ("beam_10/decoder/decoder/while/BeamSearchDecoderStep/Softmax", ("decoder", False)),
+    ("loss/sampled_softmax/sampled_softmax_loss/MatMul", ("sampled_softmax", False)),
+    ("Adam/update_embedding_tensor/ApplyAdam", ("Adam", False)),
+])
+def test_op_scope(node_name, expected):
+    assert op_scope(node_name) == expected
+
+def test_scope_table():
+    run_metadata = tf.RunMetadata()
+    stats = run_metadata.step_stats.dev_stats.add()
+    for name, micros in [("decoder/MatMul", 3000), ("gradients/decoder/MatMul_grad", 5000), ("loss/Mean", 1000)]:
+        stats.node_stats.add(node_name=name, all_end_rel_micros=micros)
+
+    rows = scope_table([run_metadata, run_metadata])
+
+    assert [row[0] for row in rows] == ["decoder", "loss"]
+    assert rows[0][1:3] == (3.0, 5.0)
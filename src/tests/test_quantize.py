@@ -0,0 +1,31 @@
+""" Testing the functionality located in src/utils/quantize """
+import os
+
+import numpy as np
+import tensorflow as tf
+
+from src.utils.quantize import fake_quantize, fake_quantize_checkpoint
+
+def test_fake_quantize():
+    weights = np.random.randn(64, 32).astype(np.float32)
+    quantized = fake_quantize(weights)
+
+    assert quantized.dtype == np.float32
+    assert len(np.unique(quantized)) <= 256
+    assert np.abs(quantized - weights).max() <= (weights.max() - weights.min())/255.0
+
+def test_fake_quantize_checkpoint(tmp_path):
+    """ Test that only the large float weights are rounded and the other variables are copied """
+    with tf.Graph().as_default(), tf.Session() as sess:
+        big = tf.Variable(np.random.randn(64, 32).astype(np.float32), name='decoder/kernel')
+        small = tf.Variable(np.random.randn(8).astype(np.float32), name='decoder/bias')
+        step = tf.Variable(7, dtype=tf.int64, name='global_step')
+        sess.run(tf.global_variables_initializer())
+        path = tf.train.Saver().save(sess, os.path.join(str(tmp_path), 'model.ckpt'))
+        values = sess.run({'decoder/kernel': big, 'decoder/bias': small, 'global_step': step})
+
+    quantized = tf.train.load_checkpoint(fake_quantize_checkpoint(path, os.path.join(str(tmp_path), 'int8.ckpt'), minimum_size=100))
+
+    assert np.array_equal(quantized.get_tensor('decoder/kernel'), fake_quantize(values['decoder/kernel']))
+    assert np.array_equal(quantized.get_tensor('decoder/bias'), values['decoder/bias'])
+    assert quantized.get_tensor('global_step') == values['global_step'] == 7
@@ -0,0 +1,154 @@
+""" Testing the functionality located in src/models/rvae """
+
+from collections import namedtuple
+
+import numpy as np
+import pytest
+import tensorflow as tf
+
+from src.models.rvae import RVAE, OutputProjection, TopKSampleEmbeddingHelper
+from src.utils.bench_step import DEFAULT_HPS
+
+def small_hps(**overrides):
+    """ Returns the default hps shrunk so that the full graph builds quickly """
+    hps_dict = dict(DEFAULT_HPS, emb_dim=8, hidden_dim=8, latent_dim=6, beam_size=3, max_dec_steps=5)
+    hps_dict.update(overrides)
+    return namedtuple("HParams", hps_dict.keys())(**hps_dict)
+
+@pytest.fixture
+def model():
+    """ Returns a model with the hps needed to build single ops """
+    hps = namedtuple("HParams", ["keep_prob"])(0.7)
+    return RVAE(hps, 100)
+
+@pytest.mark.parametrize("keep_prob", [0.0, 0.7, 1.0])
+def test_word_dropout(model, keep_prob):
+    seq = np.array([[1, 5, 6, 7, 0, 0], [1, 8, 9, 10, 11, 12]])
+    seq_len = np.array([4, 6])
+
+    with tf.Graph().as_default(), tf.Session() as sess:
+        dropped = sess.run(model._word_dropout(tf.constant(seq, dtype=tf.int64), tf.constant(seq_len, dtype=tf.int64), keep_prob))
+
+    in_seq = np.arange(seq.shape[1]) < seq_len[:, None]
+    assert np.all(dropped[~in_seq] == 0) # padding is untouched
+    assert np.all((dropped[in_seq] == seq[in_seq]) | (dropped[in_seq] == 3))
+    if keep_prob == 1.0:
+        assert np.array_equal(dropped, seq)
+    elif keep_prob == 0.0:
+        assert np.all(dropped[in_seq] == 3)
+
+def test_sampled_sequence_loss():
+    hps = namedtuple("HParams", ["hidden_dim", "softmax_samples"])(8, 5)
+    model = RVAE(hps, 50)
+    targets = np.array([[4, 5, 2, 0], [6, 7, 8, 2]])
+    masks = (targets > 0).astype(np.float32)
+
+    with tf.Graph().as_default(), tf.Session() as sess:
+        model._projection_layer = OutputProjection(50)
+        model._projection_layer(tf.zeros([0, 8]))
+        loss = model._sampled_sequence_loss(tf.random_normal([2, 4, 8]), tf.constant(targets, dtype=tf.int64), tf.constant(masks))
+        sess.run(tf.global_variables_initializer())
+        loss = sess.run(loss)
+
+    assert loss.shape == (2,)
+    assert np.all(np.isfinite(loss)) and np.all(loss > 0)
+
+@pytest.mark.parametrize("top_k", [1, 3])
+def test_top_k_sample_helper(top_k):
+    logits = np.array([[0.0, 5.0, 4.0, 3.0, 1.0], [9.0, 0.0, 8.0, 0.0, 7.0]], dtype=np.float32)
+
+    with tf.Graph().as_default(), tf.Session() as sess:
+        helper = TopKSampleEmbeddingHelper(tf.eye(5), tf.fill([2], 1), 2, softmax_temperature=0.5, top_k=top_k)
+        sample = helper.sample(0, tf.constant(logits), None)
+        samples = np.stack([sess.run(sample) for _ in range(20)])
+
+    top = np.argsort(-logits, axis=-1)[:, :top_k]
+    for row in range(2):
+        assert set(samples[:, row]) <= set(top[row])
+
+def test_batched_beam_predictions():
+    """ Test that beam search decodes a whole batch and returns every beam with its score """
+    seqs = np.array([[1, 5, 6, 2, 0], [1, 7, 2, 0, 0], [1, 8, 9, 10, 2]])
+
+    with tf.Graph().as_default(), tf.Session() as sess:
+        features = {"source_seq": tf.constant(seqs, dtype=tf.int64), "source_len": tf.constant([4, 3, 5], dtype=tf.int64)}
+        spec = RVAE(small_hps(), 20).model_fn(features, None, tf.estimator.ModeKeys.PREDICT, params={})
+        sess.run(tf.global_variables_initializer())
+        preds = sess.run(spec.predictions)
+
+    assert preds["beams"].shape[:3] == (3, 1, 3)
+    assert preds["scores"].shape == (3, 1, 3)
+    assert np.array_equal(preds["pred"], preds["beams"][:, :, 0])
+    assert np.all(np.diff(preds["scores"], axis=2) <= 0) # best beam first
+
+def test_encode_fn():
+    """ Test that the encoder-only graph returns the posterior and shares its variables with the full model """
+    seqs = np.array([[1, 5, 6, 2, 0], [1, 7, 2, 0, 0]])
+    features = lambda: {"source_seq": tf.constant(seqs, dtype=tf.int64), "source_len": tf.constant([4, 3], dtype=tf.int64)}
+
+    with tf.Graph().as_default():
+        RVAE(small_hps(), 20).model_fn(features(), None, tf.estimator.ModeKeys.PREDICT, params={})
+        model_vars = set(v.name for v in tf.global_variables())
+
+    with tf.Graph().as_default(), tf.Session() as sess:
+        spec = RVAE(small_hps(), 20).encode_fn(features(), None, tf.estimator.ModeKeys.PREDICT, params={})
+        assert set(v.name for v in tf.global_variables()) <= model_vars
+        sess.run(tf.global_variables_initializer())
+        preds = sess.run(spec.predictions)
+
+    assert preds["mu"].shape == preds["sigma"].shape == preds["z"].shape == (2, 6)
+    assert np.all(preds["sigma"] > 0)
+
+@pytest.mark.parametrize("hp_samples,num_samples", [(2, 2), (2, 4), (1, 3)])
+def test_multi_sample_predictions(hp_samples, num_samples):
+    """ Test that several latent samples are decoded per source and grouped by source """
+    seqs = np.array([[1, 5, 6, 2, 0], [1, 7, 2, 0, 0]])
+
+    with tf.Graph().as_default(), tf.Session() as sess:
+        features = {"source_seq": tf.constant(seqs, dtype=tf.int64), "source_len": tf.constant([4, 3], dtype=tf.int64),
+                    "num_samples": tf.constant(num_samples, dtype=tf.int64)}
+        spec = RVAE(small_hps(num_samples=hp_samples, decode_strategy='greedy'), 20).model_fn(features, None, tf.estimator.ModeKeys.PREDICT, params={})
+        sess.run(tf.global_variables_initializer())
+        preds, beam_preds = sess.run([spec.predictions, spec.export_outputs['beam_3'].outputs])
+
+    assert preds["pred"].shape[:2] == (2, num_samples)
+    assert beam_preds["beams"].shape[:3] == (2, num_samples, 3)
+    assert beam_preds["scores"].shape == (2, num_samples, 3)
+
+def test_gradient_accumulation():
+    """ Test that the gradients are applied once every accum_steps batches and global_step counts the updates """
+    model = RVAE(small_hps(accum_steps=3, lr=0.1), 20)
+
+    with tf.Graph().as_default(), tf.Session() as sess:
+        global_step = tf.train.get_or_create_global_step()
+        weights = tf.get_variable('weights', initializer=tf.constant([1.0, -2.0]))
+        train_op = model._train_op(tf.reduce_sum(tf.square(weights)), 0.1)
+        sess.run(tf.global_variables_initializer())
+
+        values = [sess.run(weights)]
+        for _ in range(6):
+            sess.run(train_op)
+            values.append(sess.run(weights))
+        assert sess.run(global_step) == 2
+
+    for step in [1, 2, 4, 5]:
+        assert np.array_equal(values[step], values[step-1])
+    assert not np.array_equal(values[3], values[2]) and not np.array_equal(values[6], values[5])
+
+@pytest.mark.parametrize("kind,num_params", [("full", 8*50), ("tied", 8*6), ("low_rank", 8*4 + 4*50)])
+def test_output_projection(kind, num_params):
+    """ Test that every projection makes logits over the vocab with its own number of parameters """
+    with tf.Graph().as_default(), tf.Session() as sess:
+        embedding = tf.get_variable('embedding_tensor', [50, 6])
+        layer = OutputProjection(50, kind, rank=4, embedding=embedding)
+        inputs = tf.random_normal([2, 3, 8])
+        logits = layer(inputs)
+        # the logits of a few ids from their gathered columns(the sampled softmax)
+        ids = [4, 0, 49]
+        gathered = tf.matmul(layer.bottleneck(tf.reshape(inputs, [-1, 8])), layer.columns(tf.constant(ids)))
+        sess.run(tf.global_variables_initializer())
+        logits, gathered = sess.run([logits, gathered])
+
+    assert logits.shape == (2, 3, 50)
+    assert np.allclose(logits.reshape(-1, 50)[:, ids], gathered, atol=1e-5)
+    assert sum(np.prod(v.shape.as_list()) for v in layer.trainable_variables) == num_params
@@ -1,10 +1,14 @@
 """ Testing the functionality located in src/data/vocab """
 
+import csv
 import os
 
 import pytest
 
-from src.data.vocab import Vocab
+import nltk
+import numpy as np
+
+from src.data.vocab import CachedTokenizer, RegexTokenizer, Vocab
 
 WORKING_DIR = os.path.abspath(os.path.dirname(__file__)) # path to file
 BASE_DIR = os.path.abspath(os.path.join(WORKING_DIR, "../../data"))
@@ -37,3 +41,85 @@ def test_unk_in_vocab(loaded_vocab):
     unk_seq = "This will test out of vocabulary words like phirr"
     id_list = loaded_vocab.prep_seq(unk_seq)
     assert 3 in id_list
+
+def test_prep_train_csv_matches_serial(tmp_path):
+    rows = [["A man riding a horse.", "A person is on a horse"], ["What is the best way to learn?", "How do I learn fast?"]]*50
+    data_path = os.path.join(str(tmp_path), "train_data.csv")
+    with open(data_path, 'w') as f:
+        csv.writer(f).writerows(rows)
+
+    serial = Vocab()
+    for row in rows:
+        for sent in row:
+            serial.prep_train_seq(sent)
+    parallel = Vocab()
+    parallel.prep_train_csv(data_path, num_workers=2, chunk_size=7)
+
+    assert list(parallel.token_counter.items()) == list(serial.token_counter.items())
+    for vocab, name in [(serial, "serial"), (parallel, "parallel")]:
+        os.mkdir(os.path.join(str(tmp_path), name))
+        vocab.save_vocab(os.path.join(str(tmp_path), name), max_keep=5)
+    with open(os.path.join(str(tmp_path), "serial", "vocab.tsv")) as s, open(os.path.join(str(tmp_path), "parallel", "vocab.tsv")) as p:
+        assert s.read() == p.read()
+
+@pytest.mark.parametrize("seq", [
+    "a man riding a horse down the street.",
+    "what's the best way to learn? i can't decide",
+    'he said "hello" (loudly) -- then left...',
+    "it's $3.88, or 3,36 euros; ok!",
+    "i cannot wait, gonna be fun",
+])
+def test_regex_tokenizer_matches_nltk(seq):
+    assert RegexTokenizer().tokenize(seq) == nltk.word_tokenize(seq)
+
+def test_cached_tokenizer():
+    tokenizer = CachedTokenizer(RegexTokenizer(), maxsize=2)
+    for seq in ["a dog", "a dog", "a cat", "a bird", "a dog"]:
+        assert tokenizer.tokenize(seq) == seq.split()
+    assert (tokenizer.hits, tokenizer.misses) == (1, 4)
+
+def test_read_embeddings_cache(tmp_path):
+    embed_path = os.path.join(str(tmp_path), "embed.vec")
+    with open(embed_path, 'w') as f:
+        f.write("3 4\nman 1 2 3 4\nzebra 5 5 5 5\ndog 0.5 0.5 0.5 0.5\n")
+    vocab = Vocab()
+    vocab.prep_train_seq("a man and a dog")
+
+    matrix = vocab.read_embeddings(embed_path, cache_dir=str(tmp_path))
+    assert matrix.shape == (len(vocab.vocab), 4) and matrix.dtype == np.float32
+    assert np.array_equal(matrix[vocab.vocab["man"]], [1, 2, 3, 4])
+    assert os.path.isfile(vocab._embedding_cache_path(embed_path, str(tmp_path)))
+
+    cached = vocab.read_embeddings(embed_path, cache_dir=str(tmp_path))
+    assert isinstance(cached, np.memmap)
+    assert np.array_equal(cached, matrix)
+
+def test_ids_to_text_stops_at_eos(empty_vocab):
+    empty_vocab.prep_train_seq("a man riding a horse")
+    ids = empty_vocab.prep_seq("a man riding a horse")
+    assert empty_vocab.ids_to_text(np.array(ids[1:] + [0, 0])) == "a man riding a horse"
+    assert empty_vocab.ids_to_text([ids[1:], ids[2:]]) == ["a man riding a horse", "man riding a horse"]
+
+def test_loaded_vocab_is_frozen(empty_vocab, tmp_path):
+    empty_vocab.prep_train_seq("a man riding a horse")
+    empty_vocab.save_vocab(str(tmp_path))
+
+    vocab = Vocab(os.path.join(str(tmp_path), "vocab.tsv"))
+    assert vocab.frozen and "horse" in vocab.vocab
+    with pytest.raises(Exception):
+        vocab.prep_train_seq("phirr")
+    assert "phirr" not in vocab.vocab
+
+def test_encode_batch_matches_prep_seq(loaded_vocab):
+    seqs = ["This sentence will test included words in the dictionary", "Out of vocabulary words like phirr", "Short"]
+    ids, lengths = loaded_vocab.encode_batch(seqs)
+    assert ids.shape == (3, max(lengths))
+    for row, seq in enumerate(seqs):
+        id_list = loaded_vocab.prep_seq(seq)
+        assert lengths[row] == len(id_list)
+        assert list(ids[row]) == id_list + [0]*(ids.shape[1]-len(id_list))
+
+def test_encode_batch_max_len(loaded_vocab):
+    ids, lengths = loaded_vocab.encode_batch(["This sentence will test included words in the dictionary"], max_len=5)
+    assert ids.shape == (1, 5) and lengths[0] == 5
+    assert ids[0, 0] == 1 and ids[0, -1] == 2
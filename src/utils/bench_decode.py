@@ -0,0 +1,62 @@
+""" Benchmarks the latency of the decoding strategies(beam search, greedy and sampling) of the RVAE.
+Builds the PREDICT graph once and times every exported signature on random batches. Weights are random unless
+a checkpoint is given, which only matters for when the decoders emit EOS.
+Run from the root of the repo: python -m src.utils.bench_decode --vsize=30000 --batch_sizes 1 32 --variants "beam_size=5" "beam_size=10"
+"""
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import tempfile
+import time
+from collections import namedtuple
+
+import numpy as np
+import tensorflow as tf
+
+from src.models.rvae import RVAE
+from src.utils.bench_step import DEFAULT_HPS, parse_overrides
+
+def bench(hps, vsize, seq_len, batch_sizes, steps, checkpoint=None):
+    """ Returns {(signature, batch_size): mean latency in ms} for every decoding strategy """
+    results = {}
+    with tf.Graph().as_default():
+        source_seq = tf.placeholder(tf.int64, [None, None])
+        source_len = tf.placeholder(tf.int64, [None])
+        spec = RVAE(hps, vsize).model_fn({"source_seq": source_seq, "source_len": source_len}, None, tf.estimator.ModeKeys.PREDICT, params={})
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            if checkpoint:
+                tf.train.Saver().restore(sess, checkpoint)
+            for batch_size in batch_sizes:
+                lens = np.random.randint(seq_len//2, seq_len+1, size=batch_size)
+                seqs = np.random.randint(4, vsize, size=(batch_size, seq_len)) * (np.arange(seq_len) < lens[:, None])
+                feed = {source_seq: seqs, source_len: lens}
+                for name, output in sorted(spec.export_outputs.items()):
+                    if name == tf.saved_model.signature_constants.DEFAULT_SERVING_SIGNATURE_DEF_KEY or "pred" not in output.outputs:
+                        continue
+                    pred = output.outputs["pred"]
+                    sess.run(pred, feed) # warm up
+                    start = time.time()
+                    for _ in range(steps):
+                        sess.run(pred, feed)
+                    results[(name, batch_size)] = 1000.0*(time.time() - start)/steps
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--vsize', type=int, default=30000)
+    parser.add_argument('--seq_len', type=int, default=20)
+    parser.add_argument('--steps', type=int, default=10)
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 32])
+    parser.add_argument('--max_dec_steps', type=int, default=30, help="caps decoding since random weights rarely emit EOS")
+    parser.add_argument('--checkpoint', default=None, help="checkpoint to restore the weights from. vsize and hps must match it")
+    parser.add_argument('--variants', nargs='+', default=[''], help="hp overrides for every run, e.g beam_size=5,sample_top_k=10")
+    args = parser.parse_args()
+
+    for variant in args.variants:
+        hps_dict = dict(DEFAULT_HPS, model_dir=tempfile.mkdtemp(), max_dec_steps=args.max_dec_steps)
+        hps_dict.update(parse_overrides(variant))
+        hps = namedtuple("HParams", hps_dict.keys())(**hps_dict)
+        results = bench(hps, args.vsize, args.seq_len, args.batch_sizes, args.steps, args.checkpoint)
+        for (name, batch_size), ms in sorted(results.items()):
+            print("%-30s %-10s batch=%4d  %9.1f ms/batch  %8.1f sents/s" % (variant or 'default', name, batch_size, ms, 1000.0*batch_size/ms))
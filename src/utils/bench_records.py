@@ -0,0 +1,61 @@
+""" Benchmarks the SequenceExample record format against the packed Example format.
+Writes the same encoded examples in both formats and reports the serialization time, the file size and the number
+of parsed and batched examples per second of Dataset.train_input_fn.
+Run from the root of the repo: python -m src.utils.bench_records --data=data/interim/val_data.csv
+"""
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import os
+import tempfile
+import time
+from itertools import islice
+
+import tensorflow as tf
+
+from src.data.dataset import Dataset
+from src.data.vocab import Vocab
+
+WORKING_DIR = os.path.abspath(os.path.dirname(__file__)) # path to file
+BASE_DIR = os.path.abspath(os.path.join(WORKING_DIR, "../../data"))
+
+def write(ds, data, path, packed):
+    """ Serializes and writes the examples, returns the time spent serializing """
+    serialize_time = 0.0
+    with tf.python_io.TFRecordWriter(path) as writer:
+        for raw_ex in data:
+            start = time.time()
+            ex = ds._serialize_pair(raw_ex, packed)
+            serialize_time += time.time() - start
+            writer.write(ex)
+    return serialize_time
+
+def read(ds, path, packed, batch_size, steps):
+    """ Runs the train input fn for some batches, returns the examples per second """
+    next_batch = ds.train_input_fn(path, batch_size, packed=packed).make_one_shot_iterator().get_next()
+    with tf.Session() as sess:
+        sess.run(next_batch) # warm up
+        start = time.time()
+        for _ in range(steps):
+            sess.run(next_batch)
+    return steps*batch_size/(time.time() - start)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data', default=os.path.join(BASE_DIR, "interim/val_data.csv"))
+    parser.add_argument('--vocab_path', default=os.path.join(BASE_DIR, "processed/vocab.tsv"))
+    parser.add_argument('--max_rows', type=int, default=50000)
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--steps', type=int, default=500)
+    args = parser.parse_args()
+
+    ds = Dataset(Vocab(args.vocab_path))
+    data = list(islice(ds._iter_csv_data(args.data), args.max_rows))
+    out_dir = tempfile.mkdtemp()
+
+    for name, packed in [("sequence", False), ("packed", True)]:
+        path = os.path.join(out_dir, "%s.tfrecord" % name)
+        serialize_time = write(ds, data, path, packed)
+        ex_per_sec = read(ds, path, packed, args.batch_size, args.steps)
+        print("%-8s serialize=%7.2f us/ex  size=%6.2f MB  input_fn=%9.1f ex/s" % (
+            name, 1e6*serialize_time/len(data), os.path.getsize(path)/2.0**20, ex_per_sec))
@@ -0,0 +1,48 @@
+""" Benchmarks the training throughput of distributed training with 1, 2 and 4 local workers on the same data.
+Every run trains a fresh model for --steps updates(see local_cluster.py) and the throughput is read from the
+global_step/sec summaries of the chief. Each global step is one batch of one worker.
+Run from the root of the repo: python -m src.utils.bench_scaling --workers 1 2 4 -- --data_path=data/processed/train.tfrecord
+  --vocab_path=data/processed/vocab --embed_path=data/external/wiki-news-300d-1M.vec --intra_op_threads=4
+"""
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import glob
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import tensorflow as tf
+
+from src.utils.local_cluster import launch, wait
+
+def steps_per_sec(model_dir, skip=1):
+    """ Returns the mean of the global_step/sec summaries in model_dir, skipping the first ones(warm up) """
+    values = []
+    for path in glob.glob(os.path.join(model_dir, 'events.out.tfevents.*')):
+        for event in tf.train.summary_iterator(path):
+            values.extend(v.simple_value for v in event.summary.value if v.tag == 'global_step/sec')
+    return np.mean(values[skip:]) if len(values) > skip else float('nan')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--ps', type=int, default=1)
+    parser.add_argument('--steps', type=int, default=1000)
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('train_args', nargs=argparse.REMAINDER, help="flags for train_rvae.py after --")
+    args = parser.parse_args()
+
+    train_args = args.train_args[1:] if args.train_args[:1] == ['--'] else args.train_args
+    baseline = None
+    for num_workers in args.workers:
+        model_dir = tempfile.mkdtemp()
+        flags = ['--model_dir=%s' % model_dir, '--exp_name=', '--train_iterations=%d' % args.steps, '--batch_size=%d' % args.batch_size]
+        if wait(launch(num_workers, args.ps, train_args + flags, log_dir=model_dir)) != 0:
+            raise Exception("ERROR: The run with %d workers failed, see the logs in %s" % (num_workers, model_dir))
+
+        examples = args.batch_size*steps_per_sec(model_dir)
+        baseline = baseline or examples
+        print("workers=%d  %9.1f examples/s  speedup=%.2fx" % (num_workers, examples, examples/baseline))
+        shutil.rmtree(model_dir)
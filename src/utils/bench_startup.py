@@ -0,0 +1,56 @@
+""" Benchmarks the cold start of train_rvae.py in every mode: the wall time of a short run and the peak resident memory
+of the process. Every mode runs as a new process on a trained model_dir:
+  - train resumes from the latest checkpoint for a single step
+  - eval evaluates a single batch
+  - predict and encode decode/encode the sentences of --text_path
+Run from the root of the repo: python -m src.utils.bench_startup --model_dir=results/exp --vocab_path=data/processed/vocab
+  --embed_path=data/external/wiki-news-300d-1M.vec --data_path=data/processed/train.tfrecord --eval_path=data/processed/val.tfrecord
+  --text_path=data/interim/sample.txt
+"""
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import tensorflow as tf
+
+from src.utils.local_cluster import ROOT_DIR
+
+def run(flags):
+    """ Runs train_rvae.py with flags, returns the wall time in s and the peak RSS in MB """
+    start = time.time()
+    with open(os.devnull, 'w') as devnull:
+        proc = subprocess.Popen([sys.executable, '-m', 'src.engine.train_rvae'] + flags, cwd=ROOT_DIR, stdout=devnull, stderr=devnull)
+        _, status, usage = os.wait4(proc.pid, 0)
+    if status != 0:
+        raise Exception("ERROR: train_rvae.py %s failed" % ' '.join(flags))
+    return time.time() - start, usage.ru_maxrss/1024.0 # ru_maxrss is in KB
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_dir', required=True, help="model dir with a checkpoint")
+    parser.add_argument('--vocab_path', required=True)
+    parser.add_argument('--embed_path', required=True)
+    parser.add_argument('--data_path', required=True, help="train tf.Record file(s)")
+    parser.add_argument('--eval_path', required=True)
+    parser.add_argument('--text_path', required=True, help="text file for predict and encode")
+    parser.add_argument('--modes', nargs='+', default=['train', 'eval', 'predict', 'encode'])
+    args = parser.parse_args()
+
+    step = int(tf.train.latest_checkpoint(args.model_dir).split('-')[-1])
+    common = ['--model_dir=%s' % args.model_dir, '--exp_name=', '--vocab_path=%s' % args.vocab_path, '--embed_path=%s' % args.embed_path,
+              '--eval_path=%s' % args.eval_path]
+    mode_flags = {
+        'train': ['--data_path=%s' % args.data_path, '--train_iterations=%d' % (step + 1), '--noinline_eval'],
+        'eval': ['--eval_batches=1'],
+        'predict': ['--data_path=%s' % args.text_path, '--predict_path=%s' % os.path.join(tempfile.mkdtemp(), 'paraphrases.txt')],
+        'encode': ['--data_path=%s' % args.text_path, '--encode_path=%s' % os.path.join(tempfile.mkdtemp(), 'vectors')]
+    }
+
+    for mode in args.modes:
+        secs, rss = run(['--mode=%s' % mode] + common + mode_flags[mode])
+        print("%-8s %7.1f s  peak rss=%8.1f MB" % (mode, secs, rss))
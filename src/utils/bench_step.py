@@ -0,0 +1,124 @@
+""" Benchmarks the training step time of the RVAE on random(or real) batches.
+Builds the TRAIN graph for every set of hp overrides and reports the parameter count, the mean time per step, the checkpoint size, the train perplexity
+and the exact full softmax perplexity(they differ with softmax_samples), e.g.
+Run from the root of the repo: python -m src.utils.bench_step --vsize=30000 --variants "cell_backend=basic" "cell_backend=fused"
+Comparing the output projections on real data: python -m src.utils.bench_step --data_path=data/processed/train.tfrecord
+  --vocab_path=data/processed/vocab --steps=200 --variants "projection=full" "projection=tied" "projection=low_rank,projection_rank=64"
+"""
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+from collections import namedtuple
+
+import numpy as np
+import tensorflow as tf
+
+from src.data.dataset import Dataset
+from src.data.vocab import Vocab
+from src.models.rvae import RVAE
+
+# the default profile of hps.yaml
+DEFAULT_HPS = {
+    'batch_size': 32,
+    'emb_dim': 300,
+    'hidden_dim': 600,
+    'latent_dim': 1100,
+    'dec_layers': 2,
+    'beam_size': 10,
+    'decode_strategy': 'beam',
+    'export_beam_widths': '',
+    'sample_temperature': 1.0,
+    'sample_top_k': 0,
+    'num_samples': 1,
+    'max_dec_steps': 200,
+    'lr': 0.00005,
+    'accum_steps': 1,
+    'keep_prob': 0.7,
+    'use_wdrop': True,
+    'cell_backend': 'basic',
+    'projection': 'full',
+    'projection_rank': 128,
+    'softmax_samples': 0,
+    'model_dir': '',
+    'vocab_path': ''
+}
+
+def parse_overrides(variant):
+    """ Parses 'key=value,key=value' into a dict using the types of DEFAULT_HPS """
+    overrides = {}
+    for item in filter(None, variant.split(',')):
+        key, value = item.split('=')
+        default = DEFAULT_HPS[key]
+        if isinstance(default, bool):
+            overrides[key] = value.lower() in ('1', 'true')
+        else:
+            overrides[key] = type(default)(value)
+    return overrides
+
+def random_batch(batch_size, seq_len, vsize):
+    """ Makes features and labels of random IDs with random lengths """
+    def _seqs():
+        lens = np.random.randint(seq_len//2, seq_len+1, size=batch_size)
+        seqs = np.random.randint(4, vsize, size=(batch_size, seq_len)) * (np.arange(seq_len) < lens[:, None])
+        return tf.constant(seqs, dtype=tf.int64), tf.constant(lens, dtype=tf.int64)
+    source_seq, source_len = _seqs()
+    target_seq, target_len = _seqs()
+    return {"source_seq": source_seq, "source_len": source_len}, {"target_seq": target_seq, "target_len": target_len, "decoder_tgt": target_seq}
+
+def bench(hps, vsize, seq_len, steps, data_path=None, vocab=None):
+    """ Returns the parameter count, the mean time of a train step in ms, the size of a checkpoint(with the Adam
+    slots) in MB, the train perplexity(the sampled estimate with softmax_samples) and the exact full softmax perplexity
+    of a batch after the last step. Uses the batches of data_path if given
+    """
+    with tf.Graph().as_default():
+        if data_path:
+            features, labels = Dataset(vocab).train_input_fn(data_path, hps.batch_size).make_one_shot_iterator().get_next()
+        else:
+            features, labels = random_batch(hps.batch_size, seq_len, vsize)
+        model = RVAE(hps, vsize)
+        spec = model.model_fn(features, labels, tf.estimator.ModeKeys.TRAIN, params={})
+        perplexity = tf.get_default_graph().get_tensor_by_name('perplexity:0')
+        full_perplexity = perplexity
+        if hps.softmax_samples:
+            # the decoder outputs its hidden states, project them over the whole vocab for the exact loss
+            logits = model._projection_layer(tf.get_default_graph().get_tensor_by_name('logits:0'))
+            masks = tf.sequence_mask(labels['target_len'], dtype=tf.float32)
+            full_loss = tf.contrib.seq2seq.sequence_loss(logits=logits, targets=labels['decoder_tgt'], weights=masks, average_across_batch=False)
+            full_perplexity = tf.exp(tf.reduce_mean(full_loss))
+        params = sum(np.prod(v.get_shape().as_list()) for v in tf.trainable_variables())
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            sess.run(spec.train_op) # warm up
+            start = time.time()
+            for _ in range(steps):
+                sess.run(spec.train_op)
+            ms = 1000.0*(time.time() - start)/steps
+            ppl, full_ppl = sess.run([perplexity, full_perplexity])
+
+            ckpt_dir = tempfile.mkdtemp()
+            tf.train.Saver().save(sess, os.path.join(ckpt_dir, 'model.ckpt'), write_meta_graph=False)
+            ckpt_mb = sum(os.path.getsize(os.path.join(ckpt_dir, f)) for f in os.listdir(ckpt_dir))/2.0**20
+            shutil.rmtree(ckpt_dir)
+    return params, ms, ckpt_mb, ppl, full_ppl
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--vsize', type=int, default=30000)
+    parser.add_argument('--seq_len', type=int, default=20)
+    parser.add_argument('--steps', type=int, default=20)
+    parser.add_argument('--variants', nargs='+', default=[''], help="hp overrides for every run, e.g cell_backend=fused,batch_size=64")
+    parser.add_argument('--data_path', default=None, help="tf.Record file to train on instead of random batches. Needs --vocab_path")
+    parser.add_argument('--vocab_path', default=None, help="vocab of the data_path records, sets vsize")
+    args = parser.parse_args()
+
+    vocab = Vocab(args.vocab_path) if args.vocab_path else None
+    vsize = len(vocab.vocab) if vocab else args.vsize
+    for variant in args.variants:
+        hps_dict = dict(DEFAULT_HPS, model_dir=tempfile.mkdtemp(), **parse_overrides(variant))
+        hps = namedtuple("HParams", hps_dict.keys())(**hps_dict)
+        params, ms, ckpt_mb, ppl, full_ppl = bench(hps, vsize, args.seq_len, args.steps, args.data_path, vocab)
+        print("%-40s params=%11d  %9.1f ms/step  ckpt=%8.1f MB  train ppl=%10.2f  full ppl=%10.2f" % (variant or 'default', params, ms, ckpt_mb, ppl, full_ppl))
@@ -0,0 +1,52 @@
+""" Benchmarks the tokenizer backends of the vocab on the interim CSVs.
+Reports the time per sentence of every backend, its agreement with nltk.word_tokenize and the hit rate of the LRU cache.
+Run from the root of the repo: python -m src.utils.bench_tokenizer --max_rows=100000
+"""
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import csv
+import os
+import time
+from itertools import islice
+
+from src.data.vocab import TOKENIZERS, get_tokenizer
+
+WORKING_DIR = os.path.abspath(os.path.dirname(__file__)) # path to file
+INTERIM_DIR = os.path.abspath(os.path.join(WORKING_DIR, "../../data/interim"))
+
+def read_sentences(paths, max_rows):
+    """ Reads every sentence of the first max_rows rows of the CSV files """
+    sents = []
+    for path in paths:
+        with open(path, 'r') as f:
+            for row in islice(csv.reader(f), max_rows):
+                sents.extend(sent.lower() for sent in row)
+    return sents
+
+def run(tokenizer, sents):
+    """ Tokenizes all sentences and returns the tokens and the elapsed time """
+    start = time.time()
+    tokens = [tokenizer.tokenize(sent) for sent in sents]
+    return tokens, time.time() - start
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data', nargs='+', default=[os.path.join(INTERIM_DIR, "train_data.csv"), os.path.join(INTERIM_DIR, "val_data.csv")])
+    parser.add_argument('--max_rows', type=int, default=None)
+    parser.add_argument('--cache_size', type=int, default=2**16)
+    args = parser.parse_args()
+
+    sents = read_sentences(args.data, args.max_rows)
+    print("Tokenizing %d sentences(%d unique)" % (len(sents), len(set(sents))))
+
+    reference, _ = run(get_tokenizer("nltk", cache_size=None), sents)
+    for name in sorted(TOKENIZERS):
+        for cache_size in [None, args.cache_size]:
+            tokenizer = get_tokenizer(name, cache_size=cache_size)
+            tokens, elapsed = run(tokenizer, sents)
+            agree = sum(a == b for a, b in zip(tokens, reference)) / len(sents)
+            line = "%-6s cache=%-6s %8.2f us/sent  agreement=%.5f" % (name, cache_size, 1e6*elapsed/len(sents), agree)
+            if cache_size:
+                line += "  hits=%d misses=%d" % (tokenizer.hits, tokenizer.misses)
+            print(line)
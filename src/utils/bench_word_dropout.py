@@ -0,0 +1,54 @@
+""" Microbenchmark of the batched word dropout against the old per-example tf.map_fn implementation.
+Run from the root of the repo: python -m src.utils.bench_word_dropout --batch_size=32 --max_len=40
+"""
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import time
+from collections import namedtuple
+
+import numpy as np
+import tensorflow as tf
+
+from src.models.rvae import RVAE
+
+def map_fn_word_dropout(seq, len, keep_prob):
+    """ The old implementation that handled one batch entry at a time """
+    seq = tf.cast(seq, dtype=tf.int32)
+    len = tf.cast(len, dtype=tf.int32)
+    sub_mask = tf.distributions.Bernoulli(probs=keep_prob).sample(len)
+    d_mask = tf.multiply(seq, tf.concat([sub_mask, tf.zeros(tf.size(seq)-len, dtype=tf.int32)], 0))
+    indices = tf.cast(tf.reshape(tf.where(tf.equal(sub_mask, 0)), [-1,1]), tf.int32)
+    values = tf.fill([tf.size(indices)], 3)
+    seq = tf.add(d_mask, tf.scatter_nd(indices=indices, updates=values, shape=tf.shape(seq)))
+    return (tf.cast(seq, dtype=tf.int64), tf.cast(len, dtype=tf.int64))
+
+def time_op(sess, op, steps):
+    """ Returns the mean time of running op in ms """
+    sess.run(op) # warm up
+    start = time.time()
+    for _ in range(steps):
+        sess.run(op)
+    return 1000.0*(time.time() - start)/steps
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--max_len', type=int, default=40)
+    parser.add_argument('--keep_prob', type=float, default=0.7)
+    parser.add_argument('--steps', type=int, default=1000)
+    args = parser.parse_args()
+
+    lens = np.random.randint(2, args.max_len+1, size=args.batch_size)
+    seqs = np.random.randint(4, 1000, size=(args.batch_size, args.max_len)) * (np.arange(args.max_len) < lens[:, None])
+    seq, seq_len = tf.constant(seqs, dtype=tf.int64), tf.constant(lens, dtype=tf.int64)
+
+    hps = namedtuple("HParams", ["keep_prob"])(args.keep_prob)
+    batched = RVAE(hps, 1000)._word_dropout(seq, seq_len, args.keep_prob)
+    per_example, _ = tf.map_fn(lambda x: map_fn_word_dropout(x[0], x[1], args.keep_prob), (seq, seq_len))
+
+    with tf.Session() as sess:
+        # both should drop the same fraction of the tokens
+        for name, op in [("map_fn", per_example), ("batched", batched)]:
+            dropped = np.mean([np.sum(sess.run(op) == 3)/np.sum(lens) for _ in range(100)])
+            print("%-8s %8.3f ms/batch  dropped=%.3f" % (name, time_op(sess, op, args.steps), dropped))
@@ -0,0 +1,102 @@
+""" Session run hooks that instrument training """
+from __future__ import absolute_import, division, print_function
+
+import json
+import os
+import time
+
+import tensorflow as tf
+
+class ThroughputHook(tf.train.SessionRunHook):
+    """ Records the throughput of training to tell if it's input or compute bound. Every every_n_steps steps it writes
+    the mean step time, the time blocked on the input pipeline(IteratorGetNext), examples/sec, real(non pad)
+    tokens/sec and the padding ratio of the batches to TensorBoard(throughput/*) and as a line of a JSONL file.
+    The input wait is read from a trace of every trace_every_n_steps-th step, tracing every step would slow it down.
+    """
+    def __init__(self, features, labels, log_path, every_n_steps=100, trace_every_n_steps=10, write_summaries=True, max_lines=10000):
+        """
+        Args:
+            features: The features dict of the model_fn(source_seq, source_len)
+            labels: The labels dict of the model_fn(target_seq, target_len)
+            log_path: Path of the JSONL file. It's moved to log_path.1 when it has max_lines lines
+            every_n_steps: Number of steps averaged into every record
+            trace_every_n_steps: Measure the input wait every trace_every_n_steps steps
+            write_summaries: Also write the records to TensorBoard(in the dir of log_path)
+            max_lines: Lines of the JSONL file before it's rolled over
+        """
+        self._fetches = {"source_len": features["source_len"],
+                         "target_len": labels["target_len"],
+                         "source_width": tf.shape(features["source_seq"])[1],
+                         "target_width": tf.shape(labels["target_seq"])[1]}
+        self._log_path = log_path
+        self._every_n_steps = every_n_steps
+        self._trace_every_n_steps = trace_every_n_steps
+        self._write_summaries = write_summaries
+        self._max_lines = max_lines
+
+    def begin(self):
+        self._global_step = tf.train.get_global_step()
+        self._get_next_ops = set(op.name for op in tf.get_default_graph().get_operations() if op.type == 'IteratorGetNext')
+        self._writer = tf.summary.FileWriterCache.get(os.path.dirname(self._log_path)) if self._write_summaries else None
+        self._lines = 0
+        if os.path.exists(self._log_path):
+            with open(self._log_path) as f:
+                self._lines = sum(1 for _ in f)
+        self._local_step = 0
+        self._reset()
+
+    def _reset(self):
+        self._stats = {"steps": 0, "step_secs": 0.0, "examples": 0, "tokens": 0, "padded_tokens": 0, "traced_steps": 0, "wait_secs": 0.0}
+
+    def before_run(self, run_context):
+        self._trace = self._trace_every_n_steps and self._local_step % self._trace_every_n_steps == 0
+        options = tf.RunOptions(trace_level=tf.RunOptions.SOFTWARE_TRACE) if self._trace else None
+        self._start = time.time()
+        return tf.train.SessionRunArgs(self._fetches, options=options)
+
+    def after_run(self, run_context, run_values):
+        step_secs = time.time() - self._start
+        results = run_values.results
+        batch_size = len(results["source_len"])
+
+        self._local_step += 1
+        self._stats["steps"] += 1
+        self._stats["step_secs"] += step_secs
+        self._stats["examples"] += batch_size
+        self._stats["tokens"] += int(results["source_len"].sum() + results["target_len"].sum())
+        self._stats["padded_tokens"] += batch_size*int(results["source_width"] + results["target_width"])
+        if self._trace:
+            # the time the step waited for the next batch of the input pipeline
+            self._stats["traced_steps"] += 1
+            self._stats["wait_secs"] += sum(node.all_end_rel_micros/1e6 for dev in run_values.run_metadata.step_stats.dev_stats
+                                            for node in dev.node_stats if node.node_name in self._get_next_ops)
+
+        if self._stats["steps"] >= self._every_n_steps:
+            # read after the step, fetched with the train op it may be read before or after the update
+            self._log(run_context.session.run(self._global_step))
+            self._reset()
+
+    def _log(self, global_step):
+        """ Writes the averages of the last steps """
+        stats = self._stats
+        wait_ms = 1000.0*stats["wait_secs"]/stats["traced_steps"] if stats["traced_steps"] else float('nan')
+        record = {"global_step": int(global_step),
+                  "time": time.time(),
+                  "step_ms": 1000.0*stats["step_secs"]/stats["steps"],
+                  "input_wait_ms": wait_ms,
+                  "input_wait_frac": wait_ms/(1000.0*stats["step_secs"]/stats["steps"]),
+                  "examples_per_sec": stats["examples"]/stats["step_secs"],
+                  "tokens_per_sec": stats["tokens"]/stats["step_secs"],
+                  "pad_ratio": 1.0 - float(stats["tokens"])/stats["padded_tokens"]}
+
+        if self._lines >= self._max_lines:
+            os.rename(self._log_path, self._log_path + '.1')
+            self._lines = 0
+        with open(self._log_path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+        self._lines += 1
+
+        if self._writer:
+            summary = tf.Summary(value=[tf.Summary.Value(tag='throughput/' + key, simple_value=value)
+                                        for key, value in record.items() if key not in ('global_step', 'time')])
+            self._writer.add_summary(summary, global_step)
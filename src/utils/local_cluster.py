@@ -0,0 +1,74 @@
+""" Launches distributed training of the RVAE as local processes. Every process runs train_rvae.py in train mode with
+its own TF_CONFIG: a chief, num_workers-1 workers, the parameter servers and optionally an evaluator. Every worker
+reads its own shards of data_path(see Dataset.train_input_fn). The checkpoints in model_dir are the same as with
+single process training, so eval and predict work as usual.
+Run from the root of the repo: python -m src.utils.local_cluster --workers=4 --ps=1 -- --model_dir=results --exp_name=dist
+  --data_path=data/processed/train.tfrecord --intra_op_threads=4
+"""
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "../.."))
+
+def cluster_spec(num_workers, num_ps, port=2222):
+    """ Returns the cluster of TF_CONFIG with the tasks on consecutive local ports """
+    hosts = ['localhost:%d' % (port + idx) for idx in range(num_workers + num_ps)]
+    cluster = {'chief': hosts[:1], 'ps': hosts[num_workers:]}
+    if num_workers > 1:
+        cluster['worker'] = hosts[1:num_workers]
+    return cluster
+
+def launch(num_workers, num_ps, train_args, evaluator=False, port=2222, log_dir=None):
+    """ Starts every task of the cluster
+    Args:
+        num_workers: Number of training processes, the chief included
+        num_ps: Number of parameter servers
+        train_args: Flags passed to train_rvae.py
+        evaluator: Also start an evaluator task that evaluates the new checkpoints
+        port: First port of the cluster
+        log_dir: If set, the output of every task is written to <log_dir>/<task>-<index>.log
+    Returns:
+        A dict of task type to the list of its processes
+    """
+    cluster = cluster_spec(num_workers, num_ps, port)
+    tasks = [(task_type, idx) for task_type in ('ps', 'chief', 'worker') for idx in range(len(cluster.get(task_type, [])))]
+    if evaluator:
+        tasks.append(('evaluator', 0))
+
+    procs = {}
+    for task_type, idx in tasks:
+        env = dict(os.environ, TF_CONFIG=json.dumps({'cluster': cluster, 'task': {'type': task_type, 'index': idx}}))
+        out = open(os.path.join(log_dir, '%s-%d.log' % (task_type, idx)), 'w') if log_dir else None
+        cmd = [sys.executable, '-m', 'src.engine.train_rvae', '--mode=train'] + list(train_args)
+        procs.setdefault(task_type, []).append(subprocess.Popen(cmd, env=env, cwd=ROOT_DIR, stdout=out, stderr=subprocess.STDOUT if out else None))
+    return procs
+
+def wait(procs):
+    """ Waits for the chief, workers and evaluator to finish and stops the parameter servers, which never exit.
+    Returns the exit code of the chief
+    """
+    for task_type in ('chief', 'worker', 'evaluator'):
+        for proc in procs.get(task_type, []):
+            proc.wait()
+    for proc in procs.get('ps', []):
+        proc.terminate()
+        proc.wait()
+    return procs['chief'][0].returncode
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=2, help="number of training processes, the chief included")
+    parser.add_argument('--ps', type=int, default=1, help="number of parameter servers")
+    parser.add_argument('--evaluator', action='store_true', help="start an evaluator task")
+    parser.add_argument('--port', type=int, default=2222)
+    parser.add_argument('--log_dir', default=None)
+    parser.add_argument('train_args', nargs=argparse.REMAINDER, help="flags for train_rvae.py after --")
+    args = parser.parse_args()
+
+    train_args = args.train_args[1:] if args.train_args[:1] == ['--'] else args.train_args
+    sys.exit(wait(launch(args.workers, args.ps, train_args, args.evaluator, args.port, args.log_dir)))
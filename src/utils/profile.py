@@ -0,0 +1,83 @@
+""" Helpers for the profile mode of train_rvae.py: Chrome traces of single steps and tables of where the time goes """
+from __future__ import absolute_import, division, print_function
+
+import os
+from collections import defaultdict
+
+import tensorflow as tf
+from tensorflow.python.client import timeline #pylint: disable=E0611
+
+# the scopes of the model in the per scope table, everything else is grouped by its top name scope
+MODEL_SCOPES = ('source_encoder', 'target_encoder', 'posterior', 'decoder', 'word_dropout', 'sampled_softmax', 'loss', 'grad_accum')
+
+def write_chrome_trace(run_metadata, path):
+    """ Writes the timeline of a traced step, open it in chrome://tracing """
+    trace = timeline.Timeline(run_metadata.step_stats).generate_chrome_trace_format(show_memory=True)
+    with open(path, 'w') as f:
+        f.write(trace)
+
+def op_scope(node_name):
+    """ Returns the model scope of an op and whether it's part of the backward pass
+    Args:
+        node_name: Name of the op, e.g gradients/decoder/decoder/while/BasicDecoderStep/...
+    Returns:
+        (scope, backward)
+    """
+    parts = node_name.split('/')
+    backward = parts[0] == 'gradients'
+    if backward:
+        parts = parts[1:]
+    # the innermost model scope, e.g loss/sampled_softmax/... is sampled_softmax
+    for part in reversed(parts):
+        if part in MODEL_SCOPES:
+            return part, backward
+    return parts[0].split(':')[0], backward
+
+def scope_table(run_metadatas):
+    """ Sums the time and the allocated memory of the ops of traced steps by scope
+    Args:
+        run_metadatas: A list of tf.RunMetadata of FULL_TRACE steps
+    Returns:
+        A list of (scope, forward ms, backward ms, allocated MB) per step, sorted by the total time
+    """
+    micros = defaultdict(lambda: [0, 0])
+    mem = defaultdict(int)
+    for run_metadata in run_metadatas:
+        for dev in run_metadata.step_stats.dev_stats:
+            for node in dev.node_stats:
+                scope, backward = op_scope(node.node_name)
+                micros[scope][backward] += node.all_end_rel_micros
+                mem[scope] += sum(out.tensor_description.allocation_description.requested_bytes for out in node.output)
+
+    steps = float(max(len(run_metadatas), 1))
+    rows = [(scope, fwd/1000.0/steps, bwd/1000.0/steps, mem[scope]/2.0**20/steps) for scope, (fwd, bwd) in micros.items()]
+    return sorted(rows, key=lambda row: row[1] + row[2], reverse=True)
+
+def format_scope_table(rows):
+    """ Formats the rows of scope_table with the share of the total time """
+    total = sum(row[1] + row[2] for row in rows) or 1.0
+    lines = ["%-30s %12s %12s %8s %12s" % ("scope", "fwd ms/step", "bwd ms/step", "time %", "MB/step")]
+    for scope, fwd, bwd, mb in rows:
+        lines.append("%-30s %12.2f %12.2f %7.1f%% %12.2f" % (scope, fwd, bwd, 100.0*(fwd + bwd)/total, mb))
+    return '\n'.join(lines)
+
+def profile_ops(profiler, profile_dir, name):
+    """ Writes the ranked tables of the tf profiler: by op type and by name scope(3 levels deep), ordered by time
+    Args:
+        profiler: A tf.profiler.Profiler with the traced steps added
+        profile_dir: Dir to write <name>-ops.txt and <name>-scopes.txt to
+        name: Prefix of the files
+    """
+    builder = tf.profiler.ProfileOptionBuilder
+    ops_opts = (builder(builder.time_and_memory())
+                .with_file_output(os.path.join(profile_dir, '%s-ops.txt' % name))
+                .order_by('micros')
+                .build())
+    profiler.profile_operations(options=ops_opts)
+
+    scope_opts = (builder(builder.time_and_memory())
+                  .with_file_output(os.path.join(profile_dir, '%s-scopes.txt' % name))
+                  .with_max_depth(3)
+                  .order_by('micros')
+                  .build())
+    profiler.profile_name_scope(options=scope_opts)
@@ -0,0 +1,82 @@
+""" Int8 weight quantization of exported RVAE models for CPU serving.
+The predict SavedModel is frozen and every float weight with at least minimum_size elements is stored as 8 bits with
+its min/max range(the quantize_weights graph transform). The weights are dequantized when the graph runs, so only the
+size of the model changes and not the ops that run.
+"""
+from __future__ import absolute_import, division, print_function
+
+import os
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.tools.graph_transforms import TransformGraph #pylint: disable=E0611
+
+def quantize_saved_model(export_dir, output_dir, minimum_size=1024):
+    """ Writes an int8 weight quantized copy of a SavedModel, keeping all of its signatures
+    Args:
+        export_dir: Path to the float SavedModel
+        output_dir: Path to write the quantized SavedModel to. Must not exist
+        minimum_size: Weights with fewer elements stay float32
+    Returns:
+        output_dir
+    """
+    tags = [tf.saved_model.tag_constants.SERVING]
+    with tf.Graph().as_default(), tf.Session() as sess:
+        meta_graph = tf.saved_model.loader.load(sess, tags, export_dir)
+        signatures = meta_graph.signature_def
+        inputs = sorted(set(t.name.split(':')[0] for sig in signatures.values() for t in sig.inputs.values()))
+        outputs = sorted(set(t.name.split(':')[0] for sig in signatures.values() for t in sig.outputs.values()))
+        frozen = tf.graph_util.convert_variables_to_constants(sess, sess.graph_def, outputs)
+
+    quantized = TransformGraph(frozen, inputs, outputs, ['quantize_weights(minimum_size=%d)' % minimum_size])
+
+    # the graph has no variables left, only the quantized constants
+    with tf.Graph().as_default(), tf.Session() as sess:
+        tf.import_graph_def(quantized, name='')
+        builder = tf.saved_model.builder.SavedModelBuilder(output_dir)
+        builder.add_meta_graph_and_variables(sess, tags, signature_def_map=dict(signatures))
+        builder.save()
+
+    return output_dir
+
+def fake_quantize(array):
+    """ Rounds an array to 256 levels between its min and max, the values the quantized graph computes with """
+    low, high = float(array.min()), float(array.max())
+    if high == low:
+        return array
+    scale = (high - low)/255.0
+    return (np.round((array - low)/scale)*scale + low).astype(array.dtype)
+
+def fake_quantize_checkpoint(checkpoint_path, output_path, minimum_size=1024):
+    """ Writes a copy of a checkpoint with the weights quantize_saved_model quantizes rounded to 8 bits. The float
+    graphs(e.g eval) then measure the loss of the quantized model
+    Args:
+        checkpoint_path: Path of the checkpoint to quantize
+        output_path: Path prefix of the checkpoint to write
+        minimum_size: Weights with fewer elements stay float32
+    Returns:
+        The path of the written checkpoint
+    """
+    reader = tf.train.load_checkpoint(checkpoint_path)
+    with tf.Graph().as_default(), tf.Session() as sess:
+        var_list = {}
+        for name in reader.get_variable_to_shape_map():
+            value = reader.get_tensor(name)
+            if value.dtype == np.float32 and value.size >= minimum_size:
+                value = fake_quantize(value)
+            # the placeholder keeps the weights out of the graph def
+            init = tf.placeholder(value.dtype, value.shape)
+            var_list[name] = (tf.Variable(init, name='quantized/' + name.replace(':', '_')), init, value)
+
+        sess.run([var.initializer for var, _, _ in var_list.values()], {init: value for _, init, value in var_list.values()})
+        saver = tf.train.Saver({name: var for name, (var, _, _) in var_list.items()})
+        return saver.save(sess, output_path, write_meta_graph=False)
+
+def saved_model_size(export_dir):
+    """ Returns the size of all the files of a SavedModel in bytes """
+    return sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(export_dir) for f in files)
+
+def rss_mb():
+    """ Returns the resident memory of this process in MB """
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1])*os.sysconf('SC_PAGE_SIZE')/2.0**20